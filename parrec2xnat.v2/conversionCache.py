@@ -0,0 +1,183 @@
+#!/usr/bin/python
+
+# Created 2026-10-19, Jordi Huguet, Neuroimaging ICT BBRC Barcelona
+
+####################################
+__author__      = 'Jordi Huguet'  ##
+__dateCreated__ = '20261019'      ##
+__version__     = '0.1.0'         ##
+__versionDate__ = '20261019'      ##
+####################################
+
+# conversionCache.py
+# Local content-addressed cache of PAR/REC derived files (parrec2nii NIfTI/bval/bvec, mosaicCreator snapshots)
+# Entries are keyed by a hash of the PAR content, REC size/mtime and the conversion options. Least recently
+# used entries are evicted whenever the cache grows beyond its size budget
+#
+# TO DO:
+# - ...
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+# per-entry index file: maps output keys (e.g. 'nii', 'bval', 'ORIGINAL') to cached file names
+manifestName = 'manifest.json'
+
+def sourceDigest(module):
+    '''Hash the source code of a converter module: any change to it (e.g. to the rendered pixels) invalidates its cached outputs'''
+    '''Returns an hexadecimal digest string, or the module version string if its code is not readable (e.g. frozen executables)'''
+
+    fileName = getattr(module, '__file__', None) or ''
+    if os.path.isfile(os.path.splitext(fileName)[0] + '.py') :
+        fileName = os.path.splitext(fileName)[0] + '.py'
+    try:
+        with open(fileName, 'rb') as fobj :
+            code = fobj.read()
+    except (IOError, OSError):
+        return getattr(module, '__version__', None)
+
+    # compiled-only module: leave out the .pyc header (magic number and source mtime)
+    if os.path.splitext(fileName)[1] in ['.pyc', '.pyo'] :
+        code = code[8:]
+
+    return hashlib.sha1(code).hexdigest()
+
+class ConversionCache(object):
+    ''' Class with set of functionalities for storing/retrieving conversion outputs in a local cache directory'''
+    ''' To instantiate properly, provide the cache directory and its size budget in bytes '''
+
+    def __init__(self, cacheDir, maxSize, verbose=False):
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+        self.verbose = verbose
+        if not os.path.exists(self.cacheDir) :
+            os.makedirs(self.cacheDir)
+
+    def computeKey(self, parFile, recFile, options):
+        '''Hash the PAR content, REC size and mtime and the conversion options'''
+        '''Returns an hexadecimal key string'''
+
+        digest = hashlib.sha1()
+        with open(parFile, 'rb') as fobj :
+            for chunk in iter(lambda: fobj.read(1024*1024), b'') :
+                digest.update(chunk)
+
+        recStat = os.stat(recFile)
+        digest.update('%d:%d' %(recStat.st_size, int(recStat.st_mtime)))
+        digest.update(json.dumps(options, sort_keys=True))
+
+        return digest.hexdigest()
+
+    def get(self, key, outdir):
+        '''Look for a cache entry and, if found, materialize its files into outdir'''
+        '''Returns a dictionary of output files (as the original converter does) or None if cache miss'''
+
+        entryDir = os.path.join(self.cacheDir, key)
+        manifestFile = os.path.join(entryDir, manifestName)
+        if not os.path.isfile(manifestFile) :
+            return None
+
+        outputFiles = {}
+        try:
+            with open(manifestFile, 'r') as fobj :
+                manifest = json.load(fobj)
+
+            for outKey, fileName in manifest.iteritems() :
+                if fileName is None :
+                    outputFiles[outKey] = None
+                    continue
+                outputFiles[outKey] = os.path.join(outdir, fileName)
+                try:
+                    os.link(os.path.join(entryDir, fileName), outputFiles[outKey])
+                except OSError:
+                    # hardlinks not supported or cache on another filesystem
+                    shutil.copy2(os.path.join(entryDir, fileName), outputFiles[outKey])
+        except (IOError, OSError, ValueError):
+            # entry evicted meanwhile by another process sharing the cache: drop the files materialized so far, cache miss
+            for filePath in outputFiles.values() :
+                if filePath is not None and os.path.isfile(filePath) :
+                    os.remove(filePath)
+            if self.verbose : print '[Info] Conversion cache entry gone while reading (%s)' %key
+            return None
+
+        # refresh entry last-use time (LRU bookkeeping), the materialized files outlive an entry evicted meanwhile
+        try:
+            os.utime(manifestFile, None)
+        except OSError:
+            pass
+        if self.verbose : print '[Info] Conversion cache hit (%s)' %key
+
+        return outputFiles
+
+    def put(self, key, outputFiles):
+        '''Store a set of output files as a new cache entry and evict entries beyond the size budget'''
+        '''Returns the path of the cache entry'''
+
+        entryDir = os.path.join(self.cacheDir, key)
+        if os.path.exists(entryDir) :
+            return entryDir
+
+        # entry is staged aside and atomically renamed, so concurrent readers never see a partial entry
+        stagingDir = tempfile.mkdtemp(dir=self.cacheDir, prefix='.staging_')
+        try:
+            manifest = {}
+            for outKey, filePath in outputFiles.iteritems() :
+                if filePath is None :
+                    manifest[outKey] = None
+                    continue
+                manifest[outKey] = os.path.basename(filePath)
+                shutil.copy2(filePath, os.path.join(stagingDir, manifest[outKey]))
+
+            with open(os.path.join(stagingDir, manifestName), 'w') as fobj :
+                json.dump(manifest, fobj)
+            os.rename(stagingDir, entryDir)
+        except OSError:
+            # another process stored the same entry meanwhile
+            if not os.path.exists(entryDir) :
+                raise
+        finally:
+            if os.path.exists(stagingDir) :
+                shutil.rmtree(stagingDir)
+
+        self.evict()
+
+        return entryDir
+
+    def entries(self):
+        '''List the cache entries'''
+        '''Returns a list of tuples (last-use time, size in bytes, entry path)'''
+
+        entries = []
+        for key in os.listdir(self.cacheDir) :
+            entryDir = os.path.join(self.cacheDir, key)
+            manifestFile = os.path.join(entryDir, manifestName)
+            if key.startswith('.') or not os.path.isfile(manifestFile) :
+                continue
+            try:
+                size = sum([ os.path.getsize(os.path.join(entryDir, fileName)) for fileName in os.listdir(entryDir) ])
+                entries.append((os.path.getmtime(manifestFile), size, entryDir))
+            except OSError:
+                # entry evicted meanwhile by another process sharing the cache
+                continue
+
+        return entries
+
+    def evict(self):
+        '''Remove least recently used entries until the cache fits in its size budget'''
+        '''Returns the number of bytes released'''
+
+        entries = sorted(self.entries())
+        totalSize = sum([ size for lastUse, size, entryDir in entries ])
+
+        released = 0
+        while entries and totalSize > self.maxSize :
+            lastUse, size, entryDir = entries.pop(0)
+            shutil.rmtree(entryDir, ignore_errors=True)
+            totalSize -= size
+            released += size
+            if self.verbose : print '[Info] Conversion cache entry evicted (%s)' %os.path.basename(entryDir)
+
+        return released
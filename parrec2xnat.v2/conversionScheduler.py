@@ -0,0 +1,160 @@
+#!/usr/bin/python
+
+# Created 2026-10-19, Jordi Huguet, Neuroimaging ICT BBRC Barcelona
+
+####################################
+__author__      = 'Jordi Huguet'  ##
+__dateCreated__ = '20261019'      ##
+__version__     = '0.1.0'         ##
+__versionDate__ = '20261019'      ##
+####################################
+
+# conversionScheduler.py
+# Memory-budget-aware scheduler for running PAR/REC conversions concurrently in a process pool
+# Each job peak memory is estimated from its PAR header (matrix x slices x dynamics x dtype), jobs are
+# admitted largest-first only while the sum of the in-flight estimates stays under the RAM budget
+#
+# TO DO:
+# - ...
+
+import os
+import Queue
+import numpy
+import traceback
+import multiprocessing
+# custom-brewed libraries
+import parParser
+
+# rough peak footprint of parrec2nii.convert w.r.t. the REC data size: data block read from REC,
+# reoriented copy and NIfTI output buffer. Multi-scalefactor data is promoted to float64 on top of that
+memoryCopies = 3
+# baseline memory of a worker process (interpreter, numpy, nibabel)
+processOverhead = 150 * 1024**2
+
+def estimatePeakMemory(parFile, scaling='off'):
+    '''Estimate the peak memory needed to convert a PAR/REC file pair, based on its PAR header'''
+    '''Returns the estimated number of bytes'''
+
+    hdrDict, array = parParser.parseFile(parFile)
+
+    nVoxels = int(numpy.sum(array['recon resolution'][:,0].astype(numpy.int64) * array['recon resolution'][:,1]))
+    bytesPerVoxel = int(array['image pixel size'].max()) // 8
+    estimate = nVoxels * bytesPerVoxel * memoryCopies
+
+    # scaled data with varying scale factors along the slices is converted as float64
+    slopes = array['rescale slope']
+    intercepts = array['rescale intercept']
+    if scaling != 'off' and (slopes.min() != slopes.max() or intercepts.min() != intercepts.max()) :
+        estimate += nVoxels * 8 * (memoryCopies - 1)
+
+    return estimate + processOverhead
+
+def _initWorker(startedQueue):
+    '''Worker-side initializer: keep the queue where jobs report the process running them'''
+
+    global _startedQueue
+    _startedQueue = startedQueue
+
+def _runJob(function, args, key=None):
+    '''Worker-side wrapper: never let an exception kill the scheduling loop'''
+    '''Returns a tuple (success flag, result or formatted traceback)'''
+
+    # the scheduler tells a dead (e.g. OOM-killed) worker from a long-running job by its process ID
+    _startedQueue.put((key, os.getpid()))
+    try:
+        return True, function(*args)
+    except Exception:
+        return False, traceback.format_exc()
+
+class MemoryBudgetScheduler(object):
+    ''' Class for running a set of jobs in a process pool under a memory budget'''
+    ''' To instantiate properly, provide the memory budget (bytes) and the max. number of worker processes '''
+
+    def __init__(self, budget, workers=None, verbose=False):
+        self.budget = budget
+        self.workers = workers or multiprocessing.cpu_count()
+        self.verbose = verbose
+
+    def run(self, function, jobs):
+        '''Run function(*args) for every (estimate, key, args) job, largest estimate first'''
+        '''Returns a dictionary of key: (success flag, result or formatted traceback)'''
+
+        return dict(self.iterate(function, jobs))
+
+    def iterate(self, function, jobs):
+        '''Run function(*args) for every (estimate, key, args) job, largest estimate first'''
+        '''Yields tuples (key, (success flag, result or formatted traceback)) as jobs finish'''
+
+        # largest-first (LPT) ordering keeps the longest conversions from being left for the end
+        pending = sorted(jobs, key=lambda job: job[0], reverse=True)
+        done = Queue.Queue()
+        started = multiprocessing.Queue()
+        inFlight = {}
+        runningOn = {}
+        lost = False
+
+        pool = multiprocessing.Pool(processes=self.workers, initializer=_initWorker, initargs=(started,))
+        try:
+            while pending or inFlight :
+                # admit as many jobs as fit in the budget (and worker slots), backfilling with smaller ones
+                i = 0
+                while i < len(pending) and len(inFlight) < self.workers :
+                    estimate, key, args = pending[i]
+                    # a job larger than the whole budget is only admitted when running alone
+                    if sum(inFlight.values()) + estimate <= self.budget or not inFlight :
+                        pending.pop(i)
+                        inFlight[key] = estimate
+                        if self.verbose : print '[Info] Job %s admitted (estimated %.1f MB, %.1f MB in flight)' %(key, estimate/1024.**2, sum(inFlight.values())/1024.**2)
+                        pool.apply_async(_runJob, (function, args, key), callback=lambda output, key=key: done.put((key, output)))
+                    else :
+                        i += 1
+
+                # wait for any running job to finish before trying to admit more (timeout keeps Ctrl-C responsive)
+                while True :
+                    try:
+                        key, output = done.get(True, 1)
+                    except Queue.Empty:
+                        key = self.lostJob(pool, started, inFlight, runningOn)
+                        if key is None :
+                            continue
+                        output = (False, 'Worker process running the job died (e.g. killed when running out of memory)')
+                        lost = True
+                    # results of jobs already given up on are dropped
+                    if key in inFlight :
+                        break
+                del inFlight[key]
+                runningOn.pop(key, None)
+                if not output[0] and self.verbose : print '[Warning] Job %s failed.\r\n   Reason:: %s' %(key, output[1])
+                yield key, output
+
+            # a pool never completes the lost jobs, closing it would have join() wait for them forever
+            if lost :
+                pool.terminate()
+            else :
+                pool.close()
+        except:
+            # also reached when the consumer stops iterating early (GeneratorExit)
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def lostJob(self, pool, started, inFlight, runningOn):
+        '''Liveness check: a pool replaces killed workers, but the job they were running never completes'''
+        '''Returns the key of an in-flight job whose worker process is gone (or None)'''
+
+        while True :
+            try:
+                key, pid = started.get(False)
+            except Queue.Empty:
+                break
+            if key in inFlight :
+                runningOn[key] = pid
+
+        # private Pool attribute, the list of its current worker processes
+        alive = set([ worker.pid for worker in pool._pool if worker.exitcode is None ])
+        for key, pid in runningOn.iteritems() :
+            if pid not in alive :
+                return key
+
+        return None
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+
+# Created 2026-10-19, Jordi Huguet, Neuroimaging ICT BBRC Barcelona
+
+####################################
+__author__      = 'Jordi Huguet'  ##
+__dateCreated__ = '20261019'      ##
+__version__     = '0.1.0'         ##
+__versionDate__ = '20261019'      ##
+####################################
+
+# importBenchmark.py
+# Startup cost check of the command-line tools: every module is imported in a fresh interpreter, and must
+# stay under an import time budget without loading heavy scientific packages (deferred to the code paths using them)
+#
+# TO DO:
+# - ...
+
+import os
+import sys
+import argparse
+import subprocess
+
+# heavy scientific packages the command-line tools must not load at import time
+heavyModules = ['nibabel', 'matplotlib']
+# import time budget (seconds) of the command-line tool modules
+importBudget = 1.0
+# command-line tool modules checked by default
+toolModules = ['parrec2xnat', 'mosaicCreator', 'parrecCatalog', 'snapshotBatch', 'snapshotBackfill']
+
+def benchmarkImports(moduleNames, repeats=3):
+    '''Time the import of a set of modules, each one in a fresh interpreter, and check which heavy modules they load'''
+    '''Returns a list of tuples (module name, import time in seconds, list of heavy modules loaded)'''
+
+    code = "import sys,time; start=time.time(); import %s; print time.time()-start; print ','.join([ m for m in %r if m in sys.modules ])"
+    moduleDir = os.path.dirname(os.path.abspath(__file__))
+
+    results = []
+    for moduleName in moduleNames :
+        best = None
+        for i in xrange(repeats) :
+            output = subprocess.check_output([sys.executable, '-c', code %(moduleName, heavyModules)], cwd=moduleDir)
+            elapsed, loaded = output.splitlines()
+            best = float(elapsed) if best is None else min(best, float(elapsed))
+        results.append((moduleName, best, [ m for m in loaded.split(',') if m ]))
+
+    return results
+
+###                                                        ###
+#           top-level script environment                   #
+###                                                        ###
+
+if __name__=="__main__" :
+    print ''
+
+    # argparse trickery
+    parser = argparse.ArgumentParser(description='%s :: Check the import time of the command-line tools' %os.path.basename(sys.argv[0]))
+    parser.add_argument('-im','--import_modules', dest="import_modules", nargs='+', default=toolModules, help='Modules whose import time is checked (optional)', required=False)
+    parser.add_argument('-ib','--import_budget', dest="import_budget", type=float, default=importBudget, help='Import time budget per module in seconds (optional, default: %.1f)' %importBudget, required=False)
+    parser.add_argument('-r','--repeats', dest="repeats", type=int, default=3, help='Number of timing repetitions per module (optional)', required=False)
+
+    args = vars(parser.parse_args())
+
+    overBudget = False
+    try:
+        print '%-40s %12s %8s  %s' %('module', 'import[s]', 'budget', 'heavy modules loaded')
+        for moduleName, elapsed, loaded in benchmarkImports(args['import_modules'], args['repeats']) :
+            status = 'OK' if elapsed <= args['import_budget'] and not loaded else 'FAIL'
+            overBudget = overBudget or status == 'FAIL'
+            print '%-40s %12.5f %8s  %s' %(moduleName, elapsed, status, ','.join(loaded) or '-')
+
+    except Exception as e:
+        print '[Error]', e
+        sys.exit(1)
+
+    if overBudget :
+        print '[Warning] Import time budget exceeded or heavy modules loaded at import time'
+        sys.exit(1)
@@ -20,19 +20,25 @@ __versionDate__ = '20151006'      ##
 import os
 import sys
 import argparse
-import nibabel
 import numpy
 import math
-import matplotlib
-# by default matplotlib ships configured to work with a graphical user interface which may require an X11 connection (errors running on background!)
-# 	+info:: http://matplotlib.org/faq/howto_faq.html#matplotlib-in-a-web-application-server
-matplotlib.use('Agg') 
-import matplotlib.pyplot as plot
+import zlib
+import struct
 import traceback
 
 #supported image formats
 inFormats = ['NII', 'PAR', 'REC'] # more supported input formats may come, eventually
 outFormat = 'PNG'
+# zlib compression level of the PNG files written directly (1: fastest, 9: smallest), speed matters most here
+pngCompression = 1
+# longest side (pixels) of the snapshot thumbnails
+thumbSize = 400
+# size caps of the snapshot mosaics: max. number of tiles (evenly spaced slices) and max. number of pixels
+maxTiles = 100
+maxPixels = 2048*2048
+# robust snapshot contrast: intensity percentiles used as window limits and max. number of voxels sampled to estimate them
+windowPercentiles = (0.5, 99.5)
+windowSamples = 2**18
 
 def locatePARRECFiles(fileName):
 	'''Given a file (PAR or REC), silly method for locating pairs of PAR and REC image files'''
@@ -78,7 +84,38 @@ def fileExtension(fileName):
 	
 	return (os.path.splitext(fileName)[1][1:]).upper()		
 	
+class PARRECVolumeProxy(object):
+	'''Lazy PAR/REC image data: indexing a single volume ([:,:,:,n]) only reads that volume slices from the (memory-mapped) REC file'''
+	'''Any other indexing or array conversion falls back to the nibabel array proxy'''
+	
+	def __init__(self,img):
+		self.dataobj = img.dataobj
+		self.header = img.header
+		self.recFile = img.file_map['image'].filename
+		self.shape = img.shape
+	
+	def __array__(self):
+		return numpy.asarray(self.dataobj)
+	
+	def __getitem__(self,slicer):
+		if len(self.shape)==4 and isinstance(slicer,tuple) and len(slicer)==4 and slicer[:3]==(slice(None),)*3 and isinstance(slicer[3],(int,long,numpy.integer)) :
+			return self.volume(int(slicer[3]))
+		return self.dataobj[slicer]
+	
+	def volume(self,index):
+		'''Read (and scale, dv values) the slices of the index-th volume'''
+		'''Returns a 3D numpy array'''
+		
+		nSlices = self.shape[2]
+		indices = self.header.get_sorted_slice_indices()[index*nSlices:(index+1)*nSlices]
+		recData = numpy.memmap(self.recFile, dtype=self.dataobj.dtype, mode='r', shape=self.header.get_rec_shape(), order='F')
+		
+		slopes, intercepts = self.header.get_data_scaling('dv')
+		return recData[..., indices] * slopes[...,index] + intercepts[...,index]
+
 def imageExtractor(inFile):
+	'''Load an image (NIfTI or PAR/REC) lazily: no voxel data is read until the returned object is indexed'''
+	'''Returns an array proxy (shape attribute, numpy-like indexing, numpy.asarray conversion)'''
 	
 	# Check input file path is valid 
 	if not os.path.isfile(inFile) : 
@@ -89,6 +126,9 @@ def imageExtractor(inFile):
 	if ext not in inFormats :
 		raise Exception('Unsuported file format (extension) for: %s' %os.path.basename(inFile) )	 
 
+	# deferred import, nibabel is only loaded when an image file is actually read
+	import nibabel
+	
 	# Load image data (either NIFTI or PAR/RECs)
 	if ext == 'NII' :
 		img=nibabel.load(inFile)
@@ -96,12 +136,158 @@ def imageExtractor(inFile):
 		parrecFilePair = locatePARRECFiles(inFile)	
 		img=nibabel.load(parrecFilePair['PAR'])
 	
-	#get data blob from image object
-	imageData=img.get_data()
+	#get lazy data blob from image object (nibabel array proxy reads only the sliced data for NIfTI)
+	if ext == 'NII' :
+		imageData=img.dataobj
+	else :
+		imageData=PARRECVolumeProxy(img)
 	
 	return imageData
 
-def mosaicCreator(imageData,outFile,title=None,ncols=None,colorbar=False,thumb=False):
+def assembleMosaic(imageData,ncols=None,maxTiles=None,maxPixels=None):
+	'''Lay out the slices of a 3D volume (along its shortest dimension) as a 2D grid of tiles'''
+	'''Optionally, only maxTiles evenly spaced slices are shown and tiles are shrunk to fit in maxPixels'''
+	'''Returns the mosaic 2D array'''
+	
+	# Slicing dimension is the shortest one (first of them if tied)
+	min_dim = int(numpy.argmin(imageData.shape))
+	nslices = imageData.shape[min_dim]
+	
+	# Orient all slices at once: slicing axis first, flip the last in-plane axis and transpose every slice
+	slices = numpy.moveaxis(imageData, min_dim, 0)[:,:,::-1].transpose(0,2,1)
+	
+	# Too many slices, keep an evenly spaced subset (first and last included)
+	if maxTiles is not None and nslices > maxTiles :
+		picked = numpy.unique(numpy.round(numpy.linspace(0, nslices-1, maxTiles)).astype(int))
+		slices = slices[picked]
+		nslices = len(picked)
+	
+	# Auto-compute the number of cols if not provided manually
+	if ncols == None :
+		ncols = int(math.ceil(math.sqrt(nslices)))
+	nrows = int(math.ceil(float(nslices)/ncols))
+	
+	# Mosaic over the pixel budget, shrink every tile in-plane by the smallest integer factor fitting in it
+	if maxPixels is not None :
+		height, width = slices.shape[1:]
+		factor = 1
+		while nrows*ncols * -(-height // factor) * -(-width // factor) > maxPixels :
+			factor += 1
+		if factor > 1 :
+			slices = blockMean(slices, factor)
+	height, width = slices.shape[1:]
+	
+	# Pad with empty tiles up to a full grid, then interleave grid rows/cols with tile rows/cols
+	tiles = numpy.zeros((nrows*ncols, height, width), dtype=slices.dtype)
+	tiles[:nslices] = slices
+	mosaic = tiles.reshape(nrows, ncols, height, width).transpose(0,2,1,3).reshape(nrows*height, ncols*width)
+	
+	return mosaic
+
+def estimateWindow(imageData,percentiles=windowPercentiles,maxSamples=windowSamples):
+	'''Estimate robust window limits (intensity percentiles) from a strided sample of about maxSamples voxels'''
+	'''Returns a tuple (vmin, vmax)'''
+	
+	# same step along every axis: a strided view of the volume (no copy, no full sort), whatever its memory layout
+	step = max(1, int(math.ceil((float(imageData.size)/maxSamples) ** (1.0/imageData.ndim))))
+	sample = imageData[(slice(None,None,step),) * imageData.ndim]
+	
+	# NaN voxels (e.g. masked out by some processing) left out
+	vmin, vmax = numpy.nanpercentile(sample, percentiles)
+	# flat-ish images (e.g. mostly background), fall back to the sample full range
+	if not vmax > vmin :
+		vmin, vmax = numpy.nanmin(sample), numpy.nanmax(sample)
+	# nothing but NaN voxels sampled
+	if not (numpy.isfinite(vmin) and numpy.isfinite(vmax)) :
+		vmin, vmax = 0.0, 0.0
+	
+	return float(vmin), float(vmax)
+
+def windowImage(imageData,vmin=None,vmax=None):
+	'''Map image intensities linearly onto 8-bit grayscale (min-max window by default, as imshow does)'''
+	'''Returns an uint8 numpy array'''
+	
+	# NaN voxels left out of the window, and shown black
+	if vmin is None : vmin = numpy.nanmin(imageData)
+	if vmax is None : vmax = numpy.nanmax(imageData)
+	if not (numpy.isfinite(vmin) and numpy.isfinite(vmax)) :
+		vmin, vmax = 0.0, 0.0
+	
+	image = numpy.clip(imageData.astype(numpy.float32), vmin, vmax)
+	image -= vmin
+	if vmax > vmin :
+		image *= 255.0/(vmax-vmin)
+	image += 0.5
+	image[numpy.isnan(image)] = 0
+	
+	return image.astype(numpy.uint8)
+
+def blockMean(imageData,factor):
+	'''Shrink the last two (in-plane) axes of an array by an integer factor, averaging every factor x factor block'''
+	'''Returns the downsampled array (same dtype)'''
+	
+	# pad (replicating edges) to a whole number of blocks, then average all blocks at once
+	height, width = imageData.shape[-2:]
+	padding = [(0, 0)] * (imageData.ndim - 2) + [(0, -height % factor), (0, -width % factor)]
+	padded = numpy.pad(imageData, padding, mode='edge')
+	blocks = padded.reshape(padded.shape[:-2] + (padded.shape[-2]//factor, factor, padded.shape[-1]//factor, factor))
+	means = blocks.mean(axis=(-3,-1))
+	
+	if numpy.issubdtype(imageData.dtype, numpy.integer) :
+		means = numpy.floor(means + 0.5)
+	return means.astype(imageData.dtype)
+
+def downsampleImage(image,maxSize):
+	'''Shrink a 2D image by an integer factor (block mean) so that its longest side fits in maxSize pixels'''
+	'''Returns the downsampled 2D array (same dtype)'''
+	
+	factor = int(math.ceil(float(max(image.shape))/maxSize))
+	if factor <= 1 :
+		return image
+	
+	return blockMean(image, factor)
+
+def pngChunk(chunkType,data):
+	'''Compose a PNG chunk (length, type, data, CRC)'''
+	'''Returns the chunk as a byte string'''
+	
+	chunk = chunkType + data
+	return struct.pack('>I', len(data)) + chunk + struct.pack('>I', zlib.crc32(chunk) & 0xffffffff)
+
+def writePNG(outFile,image):
+	'''Write an 8-bit grayscale 2D array as a PNG file, no rendering library involved'''
+	
+	height, width = image.shape
+	# every scanline is prefixed with its filter type byte (0: none)
+	scanlines = numpy.zeros((height, width+1), dtype=numpy.uint8)
+	scanlines[:,1:] = image
+	
+	with open(outFile, 'wb') as fobj :
+		fobj.write('\x89PNG\r\n\x1a\n')
+		fobj.write(pngChunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)))
+		fobj.write(pngChunk('IDAT', zlib.compress(scanlines.tostring(), pngCompression)))
+		fobj.write(pngChunk('IEND', ''))
+
+def renderFigure(mosaic,outFile,figsize,title=None,colorbar=False,vmin=None,vmax=None):
+	'''Render the mosaic as a matplotlib figure (only needed for titles and colorbars)'''
+	
+	import matplotlib
+	# by default matplotlib ships configured to work with a graphical user interface which may require an X11 connection (errors running on background!)
+	# 	+info:: http://matplotlib.org/faq/howto_faq.html#matplotlib-in-a-web-application-server
+	matplotlib.use('Agg') 
+	import matplotlib.pyplot as plot
+	
+	plot.figure(figsize=figsize,frameon=False)
+	plot.imshow(mosaic,cmap=plot.cm.gray,vmin=vmin,vmax=vmax)
+	if title is not None:
+		plot.title(title)
+	if colorbar:
+		plot.colorbar()
+	plot.axis('off')
+	plot.savefig(outFile,bbox_inches='tight')
+	plot.close()
+
+def mosaicCreator(imageData,outFile,title=None,ncols=None,colorbar=False,thumb=False,maxTiles=maxTiles,maxPixels=maxPixels,percentiles=windowPercentiles):
 	
 	# Assert output file extension
 	if fileExtension(outFile) != outFormat :
@@ -118,55 +304,27 @@ def mosaicCreator(imageData,outFile,title=None,ncols=None,colorbar=False,thumb=F
 	
 	# Particular case :: fMRI with several image dynamics, accept it but pick solely the first one
 	if len(imageData.shape)==4 : imageData = imageData[:,:,:,0]
+	# lazy image proxies (see imageExtractor) are read from disk at this point
+	imageData = numpy.asarray(imageData)
 		
 	if len(imageData.shape)!=3:
 		raise Exception('Input file %s is not a valid multiframe image or has an unsupported size: %s' %(outFile, imageData.shape)) 
 	
-	# Check image dimensions for the min. one
-	min_dim=numpy.where(numpy.min(imageData.shape[0:3])==imageData.shape[0:3])[0]
-	slice_dims=numpy.where(numpy.min(imageData.shape[0:3])!=imageData.shape[0:3])[0]		
-	
-	# Auto-compute the number of cols if not provided manually
-	if ncols == None :
-		ncols = int(math.ceil(math.sqrt(imageData.shape[min_dim])))
+	# size-capped mosaic: bounded snapshot cost (and PNG size) whatever the input volume size
+	mosaic = assembleMosaic(imageData, ncols, maxTiles, maxPixels)
 	
-	# Compute the number of rows the mosaic composition will have as well as the mosaic canvas size	
-	nrows=int(numpy.ceil(numpy.float(imageData.shape[min_dim])/ncols))
-	mosaic=numpy.zeros((nrows*imageData.shape[slice_dims[0]],ncols*imageData.shape[slice_dims[1]]))
+	# robust intensity window (outlier voxels do not wash out the snapshot), shared by the snapshot and its thumbnail
+	vmin, vmax = None, None
+	if percentiles is not None :
+		vmin, vmax = estimateWindow(imageData, percentiles)
 	
-	ctr=0
-		
-	for row in range(nrows):
-		rowstart=row*imageData.shape[slice_dims[0]]
-		rowend=(row+1)*imageData.shape[slice_dims[0]]
-		for col in range(ncols):
-			if ctr<imageData.shape[min_dim]:
-				colstart=col*imageData.shape[slice_dims[1]]
-				colend=(col+1)*imageData.shape[slice_dims[1]]
-				
-				if min_dim==0:
-					imgslice=imageData[ctr,:,::-1].T					
-				elif min_dim==1:
-					imgslice=imageData[:,ctr,::-1].T
-				elif min_dim==2:
-					imgslice=imageData[:,::-1,ctr].T
-				try:
-					mosaic[rowstart:rowend,colstart:colend]=imgslice#[:,:,0]
-				except:
-					mosaic[rowstart:rowend,colstart:colend]=imgslice.T#[:,:,0]
-					
-				ctr+=1
-	
-	# decent figsize for being embedded in XNAT session pages			
-	plot.figure(figsize=(12,12),frameon=False)
-	plot.imshow(mosaic,cmap=plot.cm.gray)
-	if title is not None:
-		plot.title(title)
-	if colorbar:
-		plot.colorbar()
-	plot.axis('off')
-	plot.savefig(outFile,bbox_inches='tight')
-	plot.close()
+	# plain snapshots are windowed and PNG-encoded straight from the array (native resolution)
+	if title is None and not colorbar :
+		image = windowImage(mosaic, vmin, vmax)
+		writePNG(outFile, image)
+	else :
+		# decent figsize for being embedded in XNAT session pages			
+		renderFigure(mosaic,outFile,(12,12),title,colorbar,vmin,vmax)
 	
 	thumbFile = None
 	# if specified, create a lightweight thumbnail version of the mosaic image 
@@ -179,15 +337,11 @@ def mosaicCreator(imageData,outFile,title=None,ncols=None,colorbar=False,thumb=F
 		if os.path.isfile(thumbFile) or os.path.exists(thumbFile) : 
 			raise Exception('Output file already exists: %s' %outFile )
 		
-		plot.figure(figsize=(4,4),frameon=False)
-		plot.imshow(mosaic,cmap=plot.cm.gray)
-		if title is not None:
-			plot.title(title)
-		if colorbar:
-			plot.colorbar()
-		plot.axis('off')
-		plot.savefig(thumbFile,bbox_inches='tight')
-		plot.close()
+		# thumbnail derived from the already windowed snapshot, no second rendering pass
+		if title is None and not colorbar :
+			writePNG(thumbFile, downsampleImage(image, thumbSize))
+		else :
+			renderFigure(mosaic,thumbFile,(4,4),title,colorbar,vmin,vmax)
 	
 	return { 'ORIGINAL' : outFile, 'THUMBNAIL' : thumbFile }
 	
@@ -203,6 +357,8 @@ if __name__=="__main__" :
 	parser.add_argument('-in','--inputFile', dest="inputFile", help='Input image file (NIfTI formatted)', required=True)
 	parser.add_argument('-out','--outputFile', dest="outputFile", help='Output image file (PNG formatted)', required=True)
 	parser.add_argument('-c','--cols', dest="columns", help='Number of columns/rows of the mosaic image (optional)', required=False)
+	parser.add_argument('-mt','--maxTiles', dest="maxTiles", type=int, default=maxTiles, help='Max. number of tiles (evenly spaced slices) of the mosaic image (optional, default: %d)' %maxTiles, required=False)
+	parser.add_argument('-mp','--maxPixels', dest="maxPixels", type=int, default=maxPixels, help='Max. number of pixels of the mosaic image (optional, default: %d)' %maxPixels, required=False)
 	parser.add_argument('-t','--thumb', dest="thumbnail", action='store_true', default=False, help='Create thumbnail version of the mosaic(optional)', required=False)
 	parser.add_argument('-v','--verbose', dest="verbose", action='store_true', default=False, help='Display verbosal information(optional)', required=False)
 	
@@ -213,9 +369,9 @@ if __name__=="__main__" :
 		imageDataBlob = imageExtractor(args['inputFile'])
 		
 		if args['columns'] : 
-			outputFiles = mosaicCreator(imageDataBlob,args['outputFile'],ncols=int(args['columns']), thumb=args['thumbnail'])
+			outputFiles = mosaicCreator(imageDataBlob,args['outputFile'],ncols=int(args['columns']), thumb=args['thumbnail'], maxTiles=args['maxTiles'], maxPixels=args['maxPixels'])
 		else : 
-			outputFiles = mosaicCreator(imageDataBlob,args['outputFile'], ncols=args['columns'], thumb=args['thumbnail'])
+			outputFiles = mosaicCreator(imageDataBlob,args['outputFile'], ncols=args['columns'], thumb=args['thumbnail'], maxTiles=args['maxTiles'], maxPixels=args['maxPixels'])
 		
 		if args['verbose'] : 
 			print '[Info] Snapshot file created! %s' %outputFiles['ORIGINAL']
@@ -0,0 +1,315 @@
+#!/usr/bin/python
+
+# Created 2026-10-19, Jordi Huguet, Neuroimaging ICT BBRC Barcelona
+
+# This work is based on the PAR/REC header parser developed in the NiBabel package covered by MIT License
+# Copyrighted (c) to Matthew Brett <matthew.brett@gmail.com> et al.
+
+####################################
+__author__      = 'Jordi Huguet'  ##
+__dateCreated__ = '20261019'      ##
+__version__     = '0.1.0'         ##
+__versionDate__ = '20261019'      ##
+####################################
+
+# parParser.py
+# Fast PAR header parser: general info block parsed with precompiled patterns, image information
+# table loaded in a single vectorized pass into a numpy structured array. Output is a drop-in
+# replacement of nibabel.parrec.parse_PAR_header (i.e. can feed nibabel.parrec.PARRECHeader)
+#
+# TO DO:
+# - ...
+
+import os
+import sys
+import re
+import time
+import argparse
+import numpy
+
+# General information definitions (same as nibabel.parrec)
+# values are: (shortname[, dtype[, shape]])
+# if shape is None, the number of elements is to be determined on read
+hdrKeyDict = {
+    'Patient name': ('patient_name',),
+    'Examination name': ('exam_name',),
+    'Protocol name': ('protocol_name',),
+    'Examination date/time': ('exam_date',),
+    'Series Type': ('series_type',),
+    'Acquisition nr': ('acq_nr', int),
+    'Reconstruction nr': ('recon_nr', int),
+    'Scan Duration [sec]': ('scan_duration', float),
+    'Max. number of cardiac phases': ('max_cardiac_phases', int),
+    'Max. number of echoes': ('max_echoes', int),
+    'Max. number of slices/locations': ('max_slices', int),
+    'Max. number of dynamics': ('max_dynamics', int),
+    'Max. number of mixes': ('max_mixes', int),
+    'Patient position': ('patient_position',),
+    'Preparation direction': ('prep_direction',),
+    'Technique': ('tech',),
+    'Scan resolution  (x, y)': ('scan_resolution', int, (2,)),
+    'Scan mode': ('scan_mode',),
+    'Repetition time [ms]': ('repetition_time', float, None),
+    'FOV (ap,fh,rl) [mm]': ('fov', float, (3,)),
+    'Water Fat shift [pixels]': ('water_fat_shift', float),
+    'Angulation midslice(ap,fh,rl)[degr]': ('angulation', float, (3,)),
+    'Off Centre midslice(ap,fh,rl) [mm]': ('off_center', float, (3,)),
+    'Flow compensation <0=no 1=yes> ?': ('flow_compensation', int),
+    'Presaturation     <0=no 1=yes> ?': ('presaturation', int),
+    'Phase encoding velocity [cm/sec]': ('phase_enc_velocity', float, (3,)),
+    'MTC               <0=no 1=yes> ?': ('mtc', int),
+    'SPIR              <0=no 1=yes> ?': ('spir', int),
+    'EPI factor        <0,1=no EPI>': ('epi_factor', int),
+    'Dynamic scan      <0=no 1=yes> ?': ('dyn_scan', int),
+    'Diffusion         <0=no 1=yes> ?': ('diffusion', int),
+    'Diffusion echo time [ms]': ('diffusion_echo_time', float),
+    # PAR/REC versions > 4
+    'Max. number of diffusion values': ('max_diffusion_values', int),
+    'Max. number of gradient orients': ('max_gradient_orient', int),
+    # PAR/REC version > 4.1
+    'Number of label types   <0=no ASL>': ('nr_label_types', int),
+    # spelling variants observed in the wild in V4.2 PAR files
+    'Series_data_type': ('series_type',),
+    'Patient Position': ('patient_position',),
+    'Repetition time [msec]': ('repetition_time', float, None),
+    'Diffusion echo time [msec]': ('diffusion_echo_time', float),
+}
+
+# Image information definitions (same as nibabel.parrec), one entry per column group of an image line
+imageDefDtds = {}
+imageDefDtds['V4'] = [
+    ('slice number', int),
+    ('echo number', int,),
+    ('dynamic scan number', int,),
+    ('cardiac phase number', int,),
+    ('image_type_mr', int,),
+    ('scanning sequence', int,),
+    ('index in REC file', int,),
+    ('image pixel size', int,),
+    ('scan percentage', int,),
+    ('recon resolution', int, (2,)),
+    ('rescale intercept', float),
+    ('rescale slope', float),
+    ('scale slope', float),
+    ('window center', float,),
+    ('window width', float,),
+    ('image angulation', float, (3,)),
+    ('image offcentre', float, (3,)),
+    ('slice thickness', float),
+    ('slice gap', float),
+    ('image_display_orientation', int,),
+    ('slice orientation', int,),
+    ('fmri_status_indication', int,),
+    ('image_type_ed_es', int,),
+    ('pixel spacing', float, (2,)),
+    ('echo_time', float),
+    ('dyn_scan_begin_time', float),
+    ('trigger_time', float),
+    ('diffusion_b_factor', float),
+    ('number of averages', int,),
+    ('image_flip_angle', float),
+    ('cardiac frequency', int,),
+    ('minimum RR-interval', int,),
+    ('maximum RR-interval', int,),
+    ('TURBO factor', int,),
+    ('Inversion delay', float)]
+imageDefDtds['V4.1'] = imageDefDtds['V4'] + [
+    ('diffusion b value number', int,),
+    ('gradient orientation number', int,),
+    ('contrast type', 'S30'),
+    ('diffusion anisotropy type', 'S30'),
+    ('diffusion', float, (3,)),
+]
+imageDefDtds['V4.2'] = imageDefDtds['V4.1'] + [
+    ('label type', int,),
+]
+
+# precompiled patterns: general info line (value after colon may be absent) and PAR version tag
+GEN_RE = re.compile(r".\s+(.*?)\s*:\s*(.*)")
+VERSION_RE = re.compile(r"image export tool\s+(\S+)")
+
+def splitHeader(content):
+    '''Split the PAR file content in its 3 building blocks'''
+    '''Returns the PAR version, a dictionary of raw general info values and the list of image lines'''
+
+    version = None
+    genDict = {}
+    lines = content.splitlines()
+    nLines = len(lines)
+
+    i = 0
+    # top header (comments) block, version is stated there
+    while i < nLines and not lines[i].startswith('.') :
+        match = VERSION_RE.search(lines[i])
+        if match :
+            version = match.group(1)
+        i += 1
+
+    # general information block
+    while i < nLines :
+        line = lines[i].strip()
+        if line.startswith('.') :
+            key, value = GEN_RE.match(line).groups()
+            genDict[key] = value
+        elif line.startswith('#') :
+            break
+        i += 1
+
+    # comment block (image information definition), skip it
+    while i < nLines and (lines[i].startswith('#') or not lines[i].strip()) :
+        i += 1
+
+    # image information block, ends with the trailing comment block (if any)
+    start = i
+    while i < nLines and not lines[i].startswith('#') :
+        i += 1
+    imageLines = [line for line in lines[start:i] if line.strip()]
+
+    return version, genDict, imageLines
+
+def processGenDict(genDict):
+    '''Cast the raw general info values to their meaningful type'''
+    '''Returns a dictionary of general info (nibabel-compatible keys)'''
+
+    generalInfo = {}
+    for key, value in genDict.iteritems():
+        props = hdrKeyDict[key]
+        if len(props) == 2:
+            value = props[1](value)
+        elif len(props) == 3:
+            value = numpy.fromstring(value, props[1], sep=' ')
+            if props[2] is not None:
+                value.shape = props[2]
+        generalInfo[props[0]] = value
+
+    return generalInfo
+
+def processImageLines(imageLines, version):
+    '''Load the image information lines in one vectorized pass'''
+    '''Returns a numpy structured array (one record per image line)'''
+
+    imageDefDtd = imageDefDtds[version]
+    nCols = sum([ int(numpy.prod(props[2])) if len(props) == 3 else 1 for props in imageDefDtd ])
+    nLines = len(imageLines)
+
+    # the whole table is read at once as a (lines x columns) matrix of numbers
+    table = ' '.join(imageLines)
+    values = numpy.fromstring(table, dtype=numpy.float64, sep=' ')
+    if values.size != nLines * nCols :
+        raise Exception('Image information table has an unexpected number of values (expected %d per line, PAR version %s)' %(nCols,version))
+    values = values.reshape(nLines, nCols)
+
+    imageDefs = numpy.zeros(nLines, dtype=imageDefDtd)
+    tokens = None
+    col = 0
+    for props in imageDefDtd :
+        name, npType = props[0], props[1]
+        width = int(numpy.prod(props[2])) if len(props) == 3 else 1
+        if numpy.dtype(npType).kind == 'S' :
+            # string columns keep their literal text, tokenized lazily (V4.1 onwards only)
+            if tokens is None :
+                tokens = table.split()
+            imageDefs[name] = tokens[col::nCols]
+        elif width > 1 :
+            imageDefs[name] = values[:,col:col+width]
+        else :
+            imageDefs[name] = values[:,col]
+        col += width
+
+    return imageDefs
+
+def parseHeader(fobj):
+    '''Parse a PAR header from an open file object'''
+    '''Returns 2 metadata structures of the PARREC header (dictionary of general info, array of image info)'''
+
+    version, genDict, imageLines = splitHeader(fobj.read())
+    if version not in imageDefDtds :
+        raise Exception('PAR/REC version %s is not supported' %version)
+
+    return processGenDict(genDict), processImageLines(imageLines, version)
+
+def parseFile(parFile):
+    '''Open and parse the PAR file specified'''
+    '''Returns 2 metadata structures of the PARREC header (dictionary of general info, array of image info)'''
+
+    try:
+        fobj = open(parFile, 'r')
+    except IOError:
+        raise Exception('Cannot open file: %s' %parFile)
+    else:
+        try:
+            dict,array = parseHeader(fobj)
+        finally:
+            fobj.close()
+
+    return dict,array
+
+def getVoxelSize(array):
+    '''Spatial extent of a voxel (as nibabel PARRECHeader.get_voxel_size, slice gap not included)'''
+    '''Returns a 3-element numpy array or None if not constant across the image lines'''
+
+    voxel = [ numpy.unique(array['pixel spacing'][:,0]), numpy.unique(array['pixel spacing'][:,1]), numpy.unique(array['slice thickness']) ]
+    if any([ len(values) != 1 for values in voxel ]) :
+        return None
+
+    return numpy.array([ values[0] for values in voxel ])
+
+def benchmark(parFiles, repeats=5):
+    '''Time parseHeader against nibabel.parrec.parse_PAR_header and check both outputs match'''
+    '''Returns a list of tuples (file name, image lines, nibabel time, parParser time) in seconds'''
+
+    import warnings
+    import nibabel.parrec
+
+    results = []
+    for parFile in parFiles :
+        with open(parFile, 'r') as fobj :
+            content = fobj.read()
+
+        timings = {}
+        for label, parser in [('nibabel', nibabel.parrec.parse_PAR_header), ('parParser', parseHeader)] :
+            best = None
+            for i in xrange(repeats) :
+                fobj = open(parFile, 'r')
+                start = time.time()
+                with warnings.catch_warnings() :
+                    warnings.simplefilter('ignore')
+                    output = parser(fobj)
+                elapsed = time.time() - start
+                fobj.close()
+                best = elapsed if best is None else min(best, elapsed)
+            timings[label] = (best, output)
+
+        nbDict, nbArray = timings['nibabel'][1]
+        ppDict, ppArray = timings['parParser'][1]
+        if sorted(nbDict.keys()) != sorted(ppDict.keys()) or nbArray.dtype != ppArray.dtype :
+            raise Exception('Parsed header structure mismatch for %s' %parFile)
+        for name in nbArray.dtype.names :
+            if not numpy.array_equal(nbArray[name], ppArray[name]) :
+                raise Exception('Parsed image information mismatch for %s (field: %s)' %(parFile,name))
+
+        results.append((parFile, len(ppArray), timings['nibabel'][0], timings['parParser'][0]))
+
+    return results
+
+###                                                        ###
+#           top-level script environment                   #
+###                                                        ###
+
+if __name__=="__main__" :
+    print ''
+
+    # argparse trickery
+    parser = argparse.ArgumentParser(description='%s :: Parse PAR header files (benchmarked against nibabel)' %os.path.basename(sys.argv[0]))
+    parser.add_argument('-in','--inputFile', dest="inputFiles", nargs='+', help='Input PAR file(s)', required=True)
+    parser.add_argument('-r','--repeats', dest="repeats", type=int, default=5, help='Number of timing repetitions per file (optional)', required=False)
+
+    args = vars(parser.parse_args())
+
+    try:
+        print '%-40s %8s %12s %12s %8s' %('PAR file', 'lines', 'nibabel[s]', 'parParser[s]', 'speedup')
+        for parFile, nLines, tNibabel, tParser in benchmark(args['inputFiles'], args['repeats']) :
+            print '%-40s %8d %12.5f %12.5f %7.1fx' %(os.path.basename(parFile)[-40:], nLines, tNibabel, tParser, tNibabel/max(tParser,1e-9))
+
+    except Exception as e:
+        print '[Error]', e
@@ -25,6 +25,7 @@ def convert(infile, options):
 	'''[@arg] infile :: PAR header file (REC file expected in the same directory with exact name)'''
 	'''[@arg] options :: class instance with input arguments (for integration purposes with early command-line tool version of parrec2nii)'''
 	'''Returns a structure with the output file names generated and their format'''
+	'''(plus, if a 'volume_dir' option is given, the first volume loaded published there as a sharedVolume handle under 'volume')'''
 	
 	if options['verbose'] : print('[parrec2nii] Processing %s' % infile)
 	outputFiles = {}
@@ -66,19 +67,30 @@ def convert(infile, options):
 		slope = numpy.array([1.])
 		intercept = numpy.array([0.])
 		in_data = pr_img.dataobj.get_unscaled()
+		raw_data = in_data
 		out_dtype = pr_hdr.get_data_dtype()
 	elif not numpy.any(numpy.diff(slope)) and not numpy.any(numpy.diff(intercept)):
 		# Single scalefactor case
 		slope = slope.ravel()[0]
 		intercept = intercept.ravel()[0]
 		in_data = pr_img.dataobj.get_unscaled()
+		raw_data = in_data
 		out_dtype = pr_hdr.get_data_dtype()
 	else:
 		# Multi scalefactor case
 		slope = numpy.array([1.])
 		intercept = numpy.array([0.])
 		in_data = numpy.array(pr_img.dataobj)
+		raw_data = None
 		out_dtype = numpy.float64
+	# first volume handed over as stored (dv scaling applied when read, as mosaicCreator.imageExtractor does), before being
+	# reoriented: e.g. the snapshot rendering does not read the REC file again
+	if options.get('volume_dir') is not None and raw_data is not None:
+		import sharedVolume
+		dv_slope, dv_intercept = pr_hdr.get_data_scaling('dv')
+		if raw_data.ndim == 4:
+			raw_data, dv_slope, dv_intercept = raw_data[..., 0], dv_slope[..., 0], dv_intercept[..., 0]
+		outputFiles['volume'] = sharedVolume.publishVolume(raw_data, options['volume_dir'], dv_slope, dv_intercept)
 	# Reorient data block to LAS+ if necessary
 	ornt = nibabel.orientations.io_orientation(numpy.diag([-1, 1, 1, 1]).dot(affine))
 	if numpy.all(ornt == [[0, 1],
@@ -18,11 +18,14 @@ import argparse
 import urllib
 import tempfile
 import traceback
-import nibabel
-# custom-brewed libraries
-import parrec2nii
+import multiprocessing
+# custom-brewed libraries (parrec2nii, and thus nibabel, only imported when converting to NIfTI)
+import parParser
 import xnatLibrary
 import mosaicCreator
+import conversionCache
+import conversionScheduler
+import sharedVolume
 
 def normalizeName(name):
     '''Replace awkward chars for underscores'''
@@ -76,12 +79,7 @@ def locatePARRECfiles(fileName):
     return PARRECfilepair
     
 def parseParHeader(parFile):
-##########################################################################
-# Using nibabel package, provides r/w access to neuroimaging file formats
-# Source: http://nipy.org/nibabel
-# Authors: Matthew Brett and Michael Hanke Abate
-##########################################################################    
-    '''Open and parse the PAR file specified by using nibabel module'''
+    '''Open and parse the PAR file specified by using parParser module (nibabel-compatible output)'''
     '''Returns 2 metadata structures of the PARREC header (dictionary of general info, array of image info)'''
     
     #open PAR file and parse the PAR header
@@ -91,7 +89,7 @@ def parseParHeader(parFile):
         raise Exception('Cannot open file: %s' %parFile)
     else: 
         try: 
-            dict,array = nibabel.parrec.parse_PAR_header(fobj)
+            dict,array = parParser.parseHeader(fobj)
         except Exception:
             raise Exception('%s cannot be parsed as a PAR file ' %parFile)
         finally:
@@ -99,25 +97,6 @@ def parseParHeader(parFile):
 
     return dict,array
     
-def getPARRECHeader(parFile,dict,array):
-##########################################################################
-# Using nibabel package, provides r/w access to neuroimaging file formats
-# Source: http://nipy.org/nibabel
-# Authors: Matthew Brett and Michael Hanke Abate
-##########################################################################    
-    '''Instantiate a PARRECHeader class object which provides additional info calculated/extracted from PAR/REC files'''
-    '''Returns a nibabel.parrec.PARRECHeader instance'''
-    
-    hPARREC = None
-    
-    try: 
-        hPARREC = nibabel.parrec.PARRECHeader(dict,array)
-    except Exception as e:
-        #just dump exception message, error parsing PARREC    
-        if args['verbose'] : print '[Warning] PARREC header for %s cannot be parsed.\r\n   Reason:: %s' %(os.path.basename(parFile),e)
-            
-    return hPARREC            
-
 def uploadParrecScan(XNAT,project,subject,session,scanID,fileName):
     '''Upload a duple of PAR/REC files representing an Scan resource'''
     '''Returns a HTTPlib response'''    
@@ -288,198 +267,333 @@ def uploadSnapshots(XNAT,project,subject,session,scanID,files):
             
     return
 
+def cachedConversion(cache, PARRECfilepair, options, outdir, converter):
+    '''Run a PAR/REC conversion through the local conversion cache (if any), materializing cached outputs into outdir'''
+    '''Returns a dictionary with the output files generated (as returned by the converter)'''
+    
+    if cache is None :
+        return converter()
+    
+    key = cache.computeKey(PARRECfilepair['PAR'], PARRECfilepair['REC'], options)
+    outputFiles = cache.get(key, outdir)
+    if outputFiles is None :
+        outputFiles = converter()
+        cache.put(key, outputFiles)
+    
+    return outputFiles
+
+def convertToNifti(PARRECfilepair, outdir, cache=None, verbose=False, volumeDir=None):
+    '''Convert a PAR/REC file pair to NIfTI format (through the conversion cache, if any)'''
+    '''If volumeDir is given, the first volume loaded is also handed over as a sharedVolume handle ('volume', unless cached)'''
+    '''Returns a structure with the output file names generated and their format'''
+    
+    # COMPOSE the opts for calling proc_file (parrec2nii)
+    opts = {
+    'verbose': verbose, # verbosal mode on/off
+    'outdir': outdir, # destination directory for converted NIfTI files
+    'compressed': False, # write compressed NIfTI files (gz) or not
+    'permit_truncated' : False, # disable conversion of truncated recordings  (experimental setting)
+    'bvs' : True, # write out bvals/bvecs if DTI
+    'dwell_time' : False, # do not calculate the scan dwell time
+    'origin': 'scanner', # reference point of the q-form transformation of the NIfTI image. If 'scanner', (0,0,0) = scanner's iso center
+    'minmax': ('parse', 'parse'), # mininum and maximum settings stored in the header. If 'parse' -> data scanned
+    'store_header': False, # keep information from the PAR header in an extension of the NIfTI file header
+    'scaling': 'off', # data scaling setting disabled completely (off == dv)
+    'keep_trace': False, # keep the diagnostic Philips DTI trace volume, if exists (??!!)
+    'overwrite': True, # overwrite file if it exists
+    'volume_dir': volumeDir, # location where the first volume loaded is published (sharedVolume), if any
+       }
+    
+    # deferred import: nibabel is only loaded by the runs converting to NIfTI
+    import nibabel
+    import parrec2nii
+    
+    # output location, verbosity and overwrite settings do not alter the converted data
+    cacheOpts = dict([ (key,value) for key,value in opts.iteritems() if key not in ['verbose', 'outdir', 'overwrite', 'volume_dir'] ])
+    # converter identified by its code (any edit invalidates its outputs) and the nibabel release reading the data
+    cacheOpts.update({ 'converter': 'parrec2nii', 'version': conversionCache.sourceDigest(parrec2nii), 'nibabel': nibabel.__version__ })
+    
+    # the shared volume is no output file, kept out of the cache
+    shared = {}
+    def converter():
+        outputFiles = parrec2nii.convert(PARRECfilepair['PAR'],opts)
+        shared['volume'] = outputFiles.pop('volume', None)
+        return outputFiles
+    
+    generatedFiles = cachedConversion(cache, PARRECfilepair, cacheOpts, outdir, converter)
+    if shared.get('volume') is not None :
+        generatedFiles['volume'] = shared['volume']
+    
+    return generatedFiles
+
+def findParFiles(inputDir):
+    '''Locate all recursively available PAR files at the specified location'''
+    '''Yields the PAR file names'''
+    
+    for root,dirs,files in os.walk(inputDir):
+        for fileName in files :
+            if os.path.splitext(fileName)[1].upper() == '.PAR' :
+                yield os.path.join(root,fileName)
+
+def preconvertNifti(args, cache, tmpLocation, volumeDir=None):
+    '''Convert all PAR/REC files found at the input location to NIfTI concurrently, admitting conversions under a memory budget'''
+    '''Yields tuples (PAR file, conversion outcome) as conversions finish, the outcome being (success flag, generated files structure or error traceback)'''
+    '''Files left out of the concurrent conversion come last, with no outcome (None)'''
+    '''Scans are thus ingested (raw PAR/REC upload and snapshots included) in conversion completion order, each one once its own conversion is done'''
+    '''If volumeDir is given, the converted files structures also carry the first volume loaded by the worker (see convertToNifti)'''
+    
+    jobs = []
+    outdirs = {}
+    skipped = []
+    for parFile in findParFiles(args['input']):
+        try:
+            PARRECfilepair = locatePARRECfiles(parFile)
+            estimate = conversionScheduler.estimatePeakMemory(PARRECfilepair['PAR'])
+        except Exception as e:
+            # left to the sequential stage, which reports the issue in context
+            if args['verbose'] : print '[Warning] %s skipped for concurrent NIfTI conversion.\r\n   Reason:: %s' %(os.path.basename(parFile), e)
+            skipped.append(parFile)
+            continue
+        outdirs[parFile] = tempfile.mkdtemp(dir=tmpLocation)
+        jobs.append((estimate, parFile, (PARRECfilepair, outdirs[parFile], cache, False, volumeDir)))
+    
+    scheduler = conversionScheduler.MemoryBudgetScheduler(int(args['memory_budget'] * 1024**3), args['workers'], args['verbose'])
+    
+    # ingestion (and upload) of every finished conversion overlaps the ones still running
+    for parFile, outcome in scheduler.iterate(convertToNifti, jobs):
+        # outputs of successful conversions are removed once uploaded
+        if not outcome[0] :
+            shutil.rmtree(outdirs[parFile], ignore_errors=True)
+        yield parFile, outcome
+    
+    for parFile in skipped :
+        yield parFile, None
+
 def main(XNAT,args):
-    '''Main function: Locate, load and parse all  recursively available PAR files at the specified location'''    
+    '''Main function: set up conversion helpers (cache, concurrent NIfTI conversion) and ingest the PAR/REC data'''    
     '''[@arg] XNAT :: XNAT instance'''
     '''[@arg] args :: dictionary with input arguments'''
     
-    for root,dirs,files in os.walk(args['input']):                            
-        if len(files) > 0:            
-            for n in xrange(len(files)):            
-                if ( os.path.splitext(files[n])[1].upper() == '.PAR') :
-                    
-                    #[STEP 1] : parse the PAR header file content
-                    dict, array = parseParHeader(os.path.join(root,files[n]))
-                    #get PARRECHeader class instance
-                    hPARREC = getPARRECHeader(os.path.join(root,files[n]),dict,array)
-                    
-                    #[STEP 2] : add a Subject instance to XNAT
-                    if not dict['patient_name'] : 
-                        raise Exception('SubjectName not included in PAR file %s' % os.path.join(root,files[n]) )
-                    
-                    subjectName = normalizeName(dict['patient_name'])
-                    if not subjectName or subjectName == "" : 
-                        raise Exception('Subject name not provided')                
-                    try: 
-                        resp, subjectID = XNAT.addSubject(args['project'],subjectName)
-                        if resp.status == 201 and args['verbose'] : print '[Info] Subject %s created' %subjectID
-                        
-                    except xnatLibrary.XNATException as xnatErr:
-                        if args['verbose'] : print '[Warning] Issue creating Subject.\r\n   Reason:: %s' %xnatErr
-                        
-                    #[STEP 3] : add a Session instance to XNAT
-                    dictSess = {}
-                    if 'MR' not in dict['series_type'] : 
-                        raise Exception('Unsupported or no modality attribute found, infer is an MR scan. File: %s' %xnatErr)
-                        
-                    dictSess['xnat:mrSessionData/modality'] = 'MR'
-                    dictSess['xsiType'] = 'xnat:mrSessionData'
-                    
-                    datetime = dict['exam_date'].split(" / ")
-                    date = datetime[0].split(".")
-                    dateString = date[1]+'/'+date[2]+'/'+date[0]
-                    dictSess['xnat:mrSessionData/date'] = dateString
-                    dictSess['xnat:mrSessionData/time'] = datetime[1]
-                    
-                    # [[W A R N I N G!]] This is always bringing problems due to bad PAR/REC data naming!
-                    examName = normalizeName(dict['exam_name'])
-                    #examName = subjectName + '_' + normalizeName(dict['exam_name'])
-                    #examName = subjectName + '_MR1'
-                    
-                    try: 
-                        resp, sessionID = XNAT.addSession(args['project'],subjectName,examName, dictSess)
-                        if resp.status == 201 and args['verbose'] : print '[Info] Session %s created' %sessionID
-                    
-                    except xnatLibrary.XNATException as xnatErr:
-                        if args['verbose'] : print '[Warning] Issue creating Session.\r\n   Reason:: %s' %xnatErr
-                    
-                    #[STEP 4] : add a Scan instance to XNAT
-                    dictScan = {}
-                    
-                    if 'MR' in dict['series_type'] : 
-                        dictScan['xsiType'] = 'xnat:mrScanData'
-                        dictScan['xnat:mrScanData/modality'] = 'MR'
-                    
-                    dictScan['xnat:mrScanData/series_description'] = dict['protocol_name']
-                    acqNumber = ( int(dict['acq_nr']) * 100 ) + 1
-                    dictScan['xnat:mrScanData/ID'] = str(acqNumber)
-                    
-                    # Compute the # of slices (NSG DTIPreprocessing) and add DTI-specific XNAT metadata
-                    nSlices = len(array['index in REC file'])
-                    dictScan['xnat:mrScanData/frames'] = nSlices
-                    
-                    # Following attribute not present in old-school PAR/REC files
-                    if 'max_gradient_orient' in dict :
-                        dictScan['xnat:mrScanData/parameters/diffusion/orientations'] = dict['max_gradient_orient']
-                    
-                    # DICOM compatibility: parse protocol name from PAR/REC and split WIP substring 
-                    protoName = dict['protocol_name']
-                    wippedList = protoName.split('WIP')
-                    if len(wippedList) == 1 : 
-                        dictScan['xnat:mrScanData/type'] = wippedList[0]
-                    else : 
-                        #Assume there's some typo at the beginning of the description text
-                        dictScan['xnat:mrScanData/type'] = wippedList[1]                        
-                    
-                    dictScan['xnat:mrScanData/parameters/fov/x'] = int(dict['fov'][0])
-                    dictScan['xnat:mrScanData/parameters/fov/y'] = int(dict['fov'][1])
-                    dictScan['xnat:mrScanData/parameters/tr'] = dict['repetition_time'][0]
-                    
-                    if hPARREC is not None: 
-                        voxel = hPARREC.get_voxel_size()
-                        dictScan['xnat:mrScanData/parameters/voxelRes/x'] = voxel[0]
-                        dictScan['xnat:mrScanData/parameters/voxelRes/y'] = voxel[1]
-                        dictScan['xnat:mrScanData/parameters/voxelRes/z'] = voxel[2]
-                    
-                    #params defined atomically at slice level at PAR/REC while homogeneously defined per scan at XNAT
-                    #Assumption: value is constant per all scan's slices, so will just check one (slice)
-                    dictScan['xnat:mrScanData/parameters/te'] = array['echo_time'][0]
-                    dictScan['xnat:mrScanData/parameters/ti'] = array['Inversion delay'][0]
-                    dictScan['xnat:mrScanData/parameters/flip'] = int(array['image_flip_angle'][0])
+    # optional local cache of converted files (NIfTI, snapshots), size budget given in GB
+    cache = None
+    if args['cache'] :
+        cache = conversionCache.ConversionCache(args['cache'], int(args['cache_size'] * 1024**3), args['verbose'])
+    
+    tmpBatchLocation = tempfile.mkdtemp()
+    # volumes already loaded by the conversion workers, handed over to the snapshot rendering (RAM-backed, see sharedVolume)
+    tmpVolumeLocation = None
+    if args['nifti'] and args['workers'] > 1 :
+        if args['snapshots'] :
+            tmpVolumeLocation = tempfile.mkdtemp(dir=sharedVolume.scratchRoot)
+        parFiles = preconvertNifti(args, cache, tmpBatchLocation, tmpVolumeLocation)
+    else :
+        parFiles = ( (parFile, None) for parFile in findParFiles(args['input']) )
+    
+    try:
+        ingestParrecData(XNAT, args, cache, parFiles)
+    finally:
+        # stop the conversions still running (if ingestion was aborted), then always delete the temporary directory
+        parFiles.close()
+        shutil.rmtree(tmpBatchLocation, ignore_errors=True)
+        if tmpVolumeLocation is not None :
+            shutil.rmtree(tmpVolumeLocation, ignore_errors=True)
+    
+    return
+
+def ingestParrecData(XNAT, args, cache, parFiles):
+    '''Load and parse the given PAR files and push them to XNAT'''    
+    '''[@arg] XNAT :: XNAT instance'''
+    '''[@arg] args :: dictionary with input arguments'''
+    '''[@arg] cache :: ConversionCache instance (or None)'''
+    '''[@arg] parFiles :: iterable of tuples (PAR file, NIfTI conversion outcome or None), as yielded by preconvertNifti'''
+    
+    for parFile, converted in parFiles:
+        # first volume already loaded by the conversion worker (if handed over, see preconvertNifti), no REC re-read for its snapshot
+        volume = None
+        if converted is not None and converted[0] :
+            volume = converted[1].pop('volume', None)
+        
+        #[STEP 1] : parse the PAR header file content
+        dict, array = parseParHeader(parFile)
+        
+        #[STEP 2] : add a Subject instance to XNAT
+        if not dict['patient_name'] : 
+            raise Exception('SubjectName not included in PAR file %s' % parFile )
+        
+        subjectName = normalizeName(dict['patient_name'])
+        if not subjectName or subjectName == "" : 
+            raise Exception('Subject name not provided')                
+        try: 
+            resp, subjectID = XNAT.addSubject(args['project'],subjectName)
+            if resp.status == 201 and args['verbose'] : print '[Info] Subject %s created' %subjectID
+            
+        except xnatLibrary.XNATException as xnatErr:
+            if args['verbose'] : print '[Warning] Issue creating Subject.\r\n   Reason:: %s' %xnatErr
+            
+        #[STEP 3] : add a Session instance to XNAT
+        dictSess = {}
+        if 'MR' not in dict['series_type'] : 
+            raise Exception('Unsupported or no modality attribute found, infer is an MR scan. File: %s' %xnatErr)
+            
+        dictSess['xnat:mrSessionData/modality'] = 'MR'
+        dictSess['xsiType'] = 'xnat:mrSessionData'
+        
+        datetime = dict['exam_date'].split(" / ")
+        date = datetime[0].split(".")
+        dateString = date[1]+'/'+date[2]+'/'+date[0]
+        dictSess['xnat:mrSessionData/date'] = dateString
+        dictSess['xnat:mrSessionData/time'] = datetime[1]
+        
+        # [[W A R N I N G!]] This is always bringing problems due to bad PAR/REC data naming!
+        examName = normalizeName(dict['exam_name'])
+        #examName = subjectName + '_' + normalizeName(dict['exam_name'])
+        #examName = subjectName + '_MR1'
+        
+        try: 
+            resp, sessionID = XNAT.addSession(args['project'],subjectName,examName, dictSess)
+            if resp.status == 201 and args['verbose'] : print '[Info] Session %s created' %sessionID
+        
+        except xnatLibrary.XNATException as xnatErr:
+            if args['verbose'] : print '[Warning] Issue creating Session.\r\n   Reason:: %s' %xnatErr
+        
+        #[STEP 4] : add a Scan instance to XNAT
+        dictScan = {}
+        
+        if 'MR' in dict['series_type'] : 
+            dictScan['xsiType'] = 'xnat:mrScanData'
+            dictScan['xnat:mrScanData/modality'] = 'MR'
+        
+        dictScan['xnat:mrScanData/series_description'] = dict['protocol_name']
+        acqNumber = ( int(dict['acq_nr']) * 100 ) + 1
+        dictScan['xnat:mrScanData/ID'] = str(acqNumber)
+        
+        # Compute the # of slices (NSG DTIPreprocessing) and add DTI-specific XNAT metadata
+        nSlices = len(array['index in REC file'])
+        dictScan['xnat:mrScanData/frames'] = nSlices
+        
+        # Following attribute not present in old-school PAR/REC files
+        if 'max_gradient_orient' in dict :
+            dictScan['xnat:mrScanData/parameters/diffusion/orientations'] = dict['max_gradient_orient']
+        
+        # DICOM compatibility: parse protocol name from PAR/REC and split WIP substring 
+        protoName = dict['protocol_name']
+        wippedList = protoName.split('WIP')
+        if len(wippedList) == 1 : 
+            dictScan['xnat:mrScanData/type'] = wippedList[0]
+        else : 
+            #Assume there's some typo at the beginning of the description text
+            dictScan['xnat:mrScanData/type'] = wippedList[1]                        
+        
+        dictScan['xnat:mrScanData/parameters/fov/x'] = int(dict['fov'][0])
+        dictScan['xnat:mrScanData/parameters/fov/y'] = int(dict['fov'][1])
+        dictScan['xnat:mrScanData/parameters/tr'] = dict['repetition_time'][0]
+        
+        # voxel size straight from the parsed header (no nibabel PARRECHeader instance needed)
+        voxel = parParser.getVoxelSize(array)
+        if voxel is not None: 
+            dictScan['xnat:mrScanData/parameters/voxelRes/x'] = voxel[0]
+            dictScan['xnat:mrScanData/parameters/voxelRes/y'] = voxel[1]
+            dictScan['xnat:mrScanData/parameters/voxelRes/z'] = voxel[2]
+        
+        #params defined atomically at slice level at PAR/REC while homogeneously defined per scan at XNAT
+        #Assumption: value is constant per all scan's slices, so will just check one (slice)
+        dictScan['xnat:mrScanData/parameters/te'] = array['echo_time'][0]
+        dictScan['xnat:mrScanData/parameters/ti'] = array['Inversion delay'][0]
+        dictScan['xnat:mrScanData/parameters/flip'] = int(array['image_flip_angle'][0])
+        
+        #Assumption: if a scan has to be created, data quality will be set to 'usable'
+        dictScan['quality'] = 'usable'
+        
+        try: 
+            resp = XNAT.addScan(args['project'],subjectName,examName,dictScan['xnat:mrScanData/ID'],dictScan)
+            if resp.status == 200 and args['verbose'] : print '[Info] Scan %s created' %dictScan['xnat:mrScanData/ID']
+            
+        except xnatLibrary.XNATException as xnatErr:
+            if args['verbose'] : print '[Warning] Issue creating Scan.\r\n   Reason:: %s' %xnatErr
+        
+        #[STEP 5] : upload the corresponding Scan image files                        
+        try: 
+            uploadParrecScan(XNAT,args['project'],subjectName,examName,dictScan['xnat:mrScanData/ID'],parFile)                                                            
+        except xnatLibrary.XNATException as xnatErr:
+            if args['verbose'] : print '[Warning] Unable to upload PARREC files for scan %s.\r\n   Reason:: %s' %(dictScan['xnat:mrScanData/ID'], xnatErr)
+        
+        #[STEP 6] : create and upload snapshot images for data preview (visual quality control) 
+        if args['snapshots']:
+            try:
+                tmpSnapLocation=tempfile.mkdtemp()
+                PARRECfilepair = locatePARRECfiles(parFile)
+                
+                outSnapFileName = os.path.splitext(os.path.basename(PARRECfilepair['PAR']))[0] + '.png'
+                outSnapFullFileName = os.path.join(tmpSnapLocation,outSnapFileName)
+                
+                # renderer identified by its code (any edit to it may change the rendered pixels) and the nibabel release reading the data
+                import nibabel
+                cacheOpts = { 'converter': 'mosaicCreator', 'version': conversionCache.sourceDigest(mosaicCreator), 'nibabel': nibabel.__version__, 'thumb': True,
+                              'maxTiles': mosaicCreator.maxTiles, 'maxPixels': mosaicCreator.maxPixels,
+                              'window': list(mosaicCreator.windowPercentiles) }
+                outputFiles = cachedConversion(cache, PARRECfilepair, cacheOpts, tmpSnapLocation, 
+                                               lambda: mosaicCreator.mosaicCreator(volume if volume is not None else mosaicCreator.imageExtractor(PARRECfilepair['PAR']),outSnapFullFileName,thumb=True))
+                
+            except Exception as e:
+                #just dump exception message and move ahead, they are only snapshots
+                if args['verbose'] : print '[Error] mosaic-related issue with file %s\r\n   Reason:: %s' % (PARRECfilepair['PAR'], e)
+            else: 
+                # upload the SNAPSHOT files to XNAT (REST trickery)
+                try: 
+                    uploadSnapshots(XNAT,args['project'],subjectName,examName,dictScan['xnat:mrScanData/ID'],outputFiles)                                                            
                     
-                    #Assumption: if a scan has to be created, data quality will be set to 'usable'
-                    dictScan['quality'] = 'usable'
+                except xnatLibrary.XNATException as xnatErr:
+                    if args['verbose'] : print '[Warning] Unable to upload SNAPSHOTS files for scan %s.\r\n   Reason:: %s' %(dictScan['xnat:mrScanData/ID'], xnatErr)                                
+            finally:
+                # Always delete the temporary directory (and the handed over volume)
+                if os.path.exists(tmpSnapLocation) :
+                    shutil.rmtree(tmpSnapLocation) 
+                if volume is not None :
+                    volume.release()
+
                     
+        #[STEP 7] : convert PAR/REC to NIFTI and upload the generated Scan image files
+        if args['nifti']:
+            try:        
+                tmpNiiLocation=tempfile.mkdtemp()
+            
+                PARRECfilepair = locatePARRECfiles(parFile)
+                
+                if converted is not None :
+                    # already converted concurrently (see preconvertNifti), pick its output location
+                    shutil.rmtree(tmpNiiLocation)
+                    success, generatedFiles = converted
+                    if not success :
+                        raise Exception(generatedFiles)
+                    tmpNiiLocation = os.path.dirname(generatedFiles['nii'])
+                else :
+                    generatedFiles = convertToNifti(PARRECfilepair, tmpNiiLocation, cache, args['verbose'])
+                
+                # lets use as a workaround (bug found in the conversion) the mricron tool for converting to NIfTI
+                #if 'win' in sys.platform :
+                #    args = "-x N -b L:\\basic\\divi\\Users\\jhuguet\\dcm2nii.ini -f Y -o \"%s\" %s" %(tmpNiiLocation,PARRECfilepair['PAR'])
+                #    command = 'dcm2nii.exe ' + args
+                #    sub.call(command)#, stdout=FNULL, stderr=FNULL, shell=False)
+                #elif 'linux' in sys.platform :
+                #    command = ['dcm2nii', '-b', os.path.join(os.path.expanduser('~'),'.dcm2nii','dcm2nii.ini'), '-f', 'Y', '-o', tmpNiiLocation, PARRECfilepair['PAR']]
+                #    #command = 'dcm2nii ' + args                                
+                #    sub.call(command)#, stdout=FNULL, stderr=FNULL, shell=False)
+                
+            except Exception as e:
+                #just dump exception message and move ahead, error parsing PARREC
+                if args['verbose'] : print '[Error] parrec2nii-related issue with file %s.\r\n   Reason:: %s' % (PARRECfilepair['PAR'], e)
+            else: 
+                # upload the NIFTI converted data to XNAT (REST trickery)
+                if generatedFiles.get('nii') :
                     try: 
-                        resp = XNAT.addScan(args['project'],subjectName,examName,dictScan['xnat:mrScanData/ID'],dictScan)
-                        if resp.status == 200 and args['verbose'] : print '[Info] Scan %s created' %dictScan['xnat:mrScanData/ID']
+                        uploadNiftiScan(XNAT,args['project'],subjectName,examName,dictScan['xnat:mrScanData/ID'],generatedFiles)                                                            
                         
                     except xnatLibrary.XNATException as xnatErr:
-                        if args['verbose'] : print '[Warning] Issue creating Scan.\r\n   Reason:: %s' %xnatErr
-                    
-                    #[STEP 5] : upload the corresponding Scan image files                        
-                    try: 
-                        uploadParrecScan(XNAT,args['project'],subjectName,examName,dictScan['xnat:mrScanData/ID'],os.path.join(root,files[n]))                                                            
-                    except xnatLibrary.XNATException as xnatErr:
-                        if args['verbose'] : print '[Warning] Unable to upload PARREC files for scan %s.\r\n   Reason:: %s' %(dictScan['xnat:mrScanData/ID'], xnatErr)
-                    
-                    #[STEP 6] : create and upload snapshot images for data preview (visual quality control) 
-                    if args['snapshots']:
-                        try:
-                            tmpSnapLocation=tempfile.mkdtemp()
-                            PARRECfilepair = locatePARRECfiles(os.path.join(root,files[n]))
-                            
-                            imageDataBlob = mosaicCreator.imageExtractor(PARRECfilepair['PAR'])
-                            outSnapFileName = os.path.splitext(os.path.basename(PARRECfilepair['PAR']))[0] + '.png'
-                            outSnapFullFileName = os.path.join(tmpSnapLocation,outSnapFileName)
-                            
-                            outputFiles = mosaicCreator.mosaicCreator(imageDataBlob,outSnapFullFileName,thumb=True)
-                            
-                        except Exception as e:
-                            #just dump exception message and move ahead, they are only snapshots
-                            if args['verbose'] : print '[Error] mosaic-related issue with file %s\r\n   Reason:: %s' % (PARRECfilepair['PAR'], e)
-                        else: 
-                            # upload the SNAPSHOT files to XNAT (REST trickery)
-                            try: 
-                                uploadSnapshots(XNAT,args['project'],subjectName,examName,dictScan['xnat:mrScanData/ID'],outputFiles)                                                            
-                                
-                            except xnatLibrary.XNATException as xnatErr:
-                                if args['verbose'] : print '[Warning] Unable to upload SNAPSHOTS files for scan %s.\r\n   Reason:: %s' %(dictScan['xnat:mrScanData/ID'], xnatErr)                                
-                        finally:
-                            # Always delete the temporary directory
-                            if os.path.exists(tmpSnapLocation) :
-                                shutil.rmtree(tmpSnapLocation) 
-
-                                
-                    #[STEP 7] : convert PAR/REC to NIFTI and upload the generated Scan image files
-                    if args['nifti']:
-                        try:        
-                            tmpNiiLocation=tempfile.mkdtemp()
-                        
-                            PARRECfilepair = locatePARRECfiles(os.path.join(root,files[n]))
-                            # COMPOSE the opts for calling proc_file (parrec2nii)
-                            opts = {
-                            'verbose': args['verbose'], # verbosal mode on/off
-                            'outdir': tmpNiiLocation, # destination directory for converted NIfTI files
-                            'compressed': False, # write compressed NIfTI files (gz) or not
-                            'permit_truncated' : False, # disable conversion of truncated recordings  (experimental setting)
-                            'bvs' : True, # write out bvals/bvecs if DTI
-                            'dwell_time' : False, # do not calculate the scan dwell time
-                            'origin': 'scanner', # reference point of the q-form transformation of the NIfTI image. If 'scanner', (0,0,0) = scanner's iso center
-                            'minmax': ('parse', 'parse'), # mininum and maximum settings stored in the header. If 'parse' -> data scanned
-                            'store_header': False, # keep information from the PAR header in an extension of the NIfTI file header
-                            'scaling': 'off', # data scaling setting disabled completely (off == dv)
-                            'keep_trace': False, # keep the diagnostic Philips DTI trace volume, if exists (??!!)
-                            'overwrite': True, # overwrite file if it exists
-                               }
-                            
-                            generatedFiles = parrec2nii.convert(PARRECfilepair['PAR'],opts)
-                            
-                            # lets use as a workaround (bug found in the conversion) the mricron tool for converting to NIfTI
-                            #if 'win' in sys.platform :
-                            #    args = "-x N -b L:\\basic\\divi\\Users\\jhuguet\\dcm2nii.ini -f Y -o \"%s\" %s" %(tmpNiiLocation,PARRECfilepair['PAR'])
-                            #    command = 'dcm2nii.exe ' + args
-                            #    sub.call(command)#, stdout=FNULL, stderr=FNULL, shell=False)
-                            #elif 'linux' in sys.platform :
-                            #    command = ['dcm2nii', '-b', os.path.join(os.path.expanduser('~'),'.dcm2nii','dcm2nii.ini'), '-f', 'Y', '-o', tmpNiiLocation, PARRECfilepair['PAR']]
-                            #    #command = 'dcm2nii ' + args                                
-                            #    sub.call(command)#, stdout=FNULL, stderr=FNULL, shell=False)
-                            
-                        except Exception as e:
-                            #just dump exception message and move ahead, error parsing PARREC
-                            if args['verbose'] : print '[Error] parrec2nii-related issue with file %s.\r\n   Reason:: %s' % (PARRECfilepair['PAR'], e)
-                        else: 
-                            # upload the NIFTI converted data to XNAT (REST trickery)
-                            if generatedFiles.get('nii') :
-                                try: 
-                                    uploadNiftiScan(XNAT,args['project'],subjectName,examName,dictScan['xnat:mrScanData/ID'],generatedFiles)                                                            
-                                    
-                                except xnatLibrary.XNATException as xnatErr:
-                                    if args['verbose'] : print '[Warning] Unable to upload NIFTI files for scan %s.\r\n   Reason:: %s' %(dictScan['xnat:mrScanData/ID'], xnatErr)                                
-                        finally:
-                            # Always delete the temporary directory
-                            if os.path.exists(tmpNiiLocation) :
-                                shutil.rmtree(tmpNiiLocation) 
+                        if args['verbose'] : print '[Warning] Unable to upload NIFTI files for scan %s.\r\n   Reason:: %s' %(dictScan['xnat:mrScanData/ID'], xnatErr)                                
+            finally:
+                # Always delete the temporary directory
+                if os.path.exists(tmpNiiLocation) :
+                    shutil.rmtree(tmpNiiLocation) 
         
     return
 
@@ -489,6 +603,8 @@ def main(XNAT,args):
 ###                                                        ###
 
 if __name__=="__main__" :
+    # frozen (py2exe) Windows executables: run the conversion worker processes instead of the script
+    multiprocessing.freeze_support()
     print ''
     #'parrec2xnat :: Parse and upload PARREC data to XNAT archive (version 2)'
     
@@ -500,6 +616,10 @@ if __name__=="__main__" :
     parser.add_argument('-i','--input', dest="input", help='Input PAR/REC data location', required=True)    
     parser.add_argument('-nii','--nifti', dest="nifti", action='store_true', default=False, help='Additionally upload input data in NIfTI format', required=False)    
     parser.add_argument('-s','--snapshots', dest="snapshots", action='store_true', default=False, help='Create snapshots for visual data quality control (optional)', required=False)
+    parser.add_argument('-c','--cache', dest="cache", default=None, help='Local cache directory for converted NIfTI/snapshot files, reused on re-ingestion (optional)', required=False)
+    parser.add_argument('-cs','--cache_size', dest="cache_size", type=float, default=10.0, help='Conversion cache size budget in GB (optional, default: 10)', required=False)
+    parser.add_argument('-w','--workers', dest="workers", type=int, default=1, help='Number of concurrent NIfTI conversion processes (optional, default: 1)', required=False)
+    parser.add_argument('-mb','--memory_budget', dest="memory_budget", type=float, default=8.0, help='RAM budget in GB shared by concurrent NIfTI conversions (optional, default: 8)', required=False)
     parser.add_argument('-v','--verbose', dest="verbose", action='store_true', default=False, help='Display verbosal information (optional)', required=False)
     
     args = vars(parser.parse_args())
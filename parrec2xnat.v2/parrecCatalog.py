@@ -0,0 +1,150 @@
+#!/usr/bin/python
+
+# Created 2026-10-19, Jordi Huguet, Neuroimaging ICT BBRC Barcelona
+
+####################################
+__author__      = 'Jordi Huguet'  ##
+__dateCreated__ = '20261019'      ##
+__version__     = '0.1.0'         ##
+__versionDate__ = '20261019'      ##
+####################################
+
+# parrecCatalog.py
+# Header-only batch mode: parse PAR files in a process pool (REC data never touched) and dump the scan
+# metadata parrec2xnat would push to XNAT (STEP 3/4) as a compact JSON-lines or CSV catalog
+#
+# TO DO:
+# - ...
+
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import traceback
+import multiprocessing
+# custom-brewed libraries
+import parParser
+
+# catalog columns (order kept in CSV output)
+catalogFields = ['file', 'patient_name', 'exam_name', 'exam_date', 'protocol_name', 'series_type', 'acq_nr', 'scan_id',
+                 'frames', 'fov_x', 'fov_y', 'tr', 'te', 'ti', 'flip', 'voxel_x', 'voxel_y', 'voxel_z',
+                 'max_gradient_orient', 'error']
+
+def locatePARfiles(inputLocation):
+    '''Walk-through the input location looking for PAR files'''
+    '''Returns a list of PAR file paths'''
+
+    parFiles = []
+    for root,dirs,files in os.walk(inputLocation):
+        for fileName in files :
+            if os.path.splitext(fileName)[1].upper() == '.PAR' :
+                parFiles.append(os.path.join(root,fileName))
+
+    return parFiles
+
+def extractMetadata(parFile):
+    '''Parse a PAR header and derive the scan metadata (as in parrec2xnat STEP 3/4)'''
+    '''Returns a flat dictionary with the catalog fields (error field filled on failure)'''
+
+    record = dict.fromkeys(catalogFields)
+    record['file'] = parFile
+    try:
+        hdrDict,array = parParser.parseFile(parFile)
+
+        record['patient_name'] = hdrDict['patient_name']
+        record['exam_name'] = hdrDict['exam_name']
+        record['exam_date'] = hdrDict['exam_date']
+        record['protocol_name'] = hdrDict['protocol_name']
+        record['series_type'] = hdrDict['series_type']
+        record['acq_nr'] = int(hdrDict['acq_nr'])
+        record['scan_id'] = str(( int(hdrDict['acq_nr']) * 100 ) + 1)
+        record['frames'] = len(array['index in REC file'])
+        record['fov_x'] = int(hdrDict['fov'][0])
+        record['fov_y'] = int(hdrDict['fov'][1])
+        record['tr'] = float(hdrDict['repetition_time'][0])
+        record['te'] = float(array['echo_time'][0])
+        record['ti'] = float(array['Inversion delay'][0])
+        record['flip'] = int(array['image_flip_angle'][0])
+
+        voxel = parParser.getVoxelSize(array)
+        if voxel is not None :
+            record['voxel_x'], record['voxel_y'], record['voxel_z'] = [ float(v) for v in voxel ]
+
+        # Following attribute not present in old-school PAR/REC files
+        if 'max_gradient_orient' in hdrDict :
+            record['max_gradient_orient'] = int(hdrDict['max_gradient_orient'])
+
+    except Exception as e:
+        record['error'] = str(e)
+
+    return record
+
+def buildCatalog(parFiles, outFile, outFormat='jsonl', workers=None, verbose=False):
+    '''Parse a set of PAR files in a process pool and write their metadata records to outFile'''
+    '''Returns a tuple (number of records written, number of failed files)'''
+
+    pool = multiprocessing.Pool(processes=workers)
+    nRecords, nErrors = 0, 0
+    try:
+        with open(outFile, 'wb') as fobj :
+            if outFormat == 'csv' :
+                writer = csv.DictWriter(fobj, fieldnames=catalogFields)
+                writer.writeheader()
+
+            # unordered results, chunked to amortize the inter-process messaging over many small headers
+            chunksize = max(1, min(64, len(parFiles) // (4 * (workers or multiprocessing.cpu_count())) ))
+            for record in pool.imap_unordered(extractMetadata, parFiles, chunksize) :
+                if outFormat == 'csv' :
+                    writer.writerow(record)
+                else :
+                    fobj.write(json.dumps(record, sort_keys=True, separators=(',',':'), encoding='latin-1') + '\n')
+
+                nRecords += 1
+                if record['error'] is not None :
+                    nErrors += 1
+                    if verbose : print '[Warning] %s cannot be parsed.\r\n   Reason:: %s' %(record['file'], record['error'])
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return nRecords, nErrors
+
+###                                                        ###
+#           top-level script environment                   #
+###                                                        ###
+
+if __name__=="__main__" :
+    print ''
+
+    # argparse trickery
+    parser = argparse.ArgumentParser(description='%s :: Catalog PAR/REC scan metadata (header-only, no XNAT connection)' %os.path.basename(sys.argv[0]))
+    parser.add_argument('-i','--input', dest="input", help='Input PAR/REC data location', required=True)
+    parser.add_argument('-o','--output', dest="output", help='Output catalog file', required=True)
+    parser.add_argument('-f','--format', dest="format", choices=['jsonl', 'csv'], default='jsonl', help='Catalog file format (optional, default: jsonl)', required=False)
+    parser.add_argument('-w','--workers', dest="workers", type=int, default=None, help='Number of parsing processes (optional, default: number of CPUs)', required=False)
+    parser.add_argument('-v','--verbose', dest="verbose", action='store_true', default=False, help='Display verbosal information (optional)', required=False)
+
+    args = vars(parser.parse_args())
+
+    try:
+        # check validity of input directory provided
+        if not os.path.exists(args['input']) :
+            raise Exception('Input directory ("%s") not found' %args['input'])
+
+        start = time.time()
+        parFiles = locatePARfiles(args['input'])
+        if args['verbose'] : print '[Info] %d PAR files found at %s' %(len(parFiles), args['input'])
+
+        nRecords, nErrors = buildCatalog(parFiles, args['output'], args['format'], args['workers'], args['verbose'])
+        elapsed = time.time() - start
+
+        print '[Info] %d records written to %s (%d failed) in %.2f s (%.0f files/s)' %(nRecords, args['output'], nErrors, elapsed, nRecords/max(elapsed,1e-9))
+
+    except Exception as e:
+        print '[Error]', e
+        print(traceback.format_exc())
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+
+# Created 2026-10-19, Jordi Huguet, Neuroimaging ICT BBRC Barcelona
+
+####################################
+__author__      = 'Jordi Huguet'  ##
+__dateCreated__ = '20261019'      ##
+__version__     = '0.1.0'         ##
+__versionDate__ = '20261019'      ##
+####################################
+
+# sharedVolume.py
+# Zero-copy hand-off of image volumes between worker processes: a volume is published once into a memory-mapped
+# scratch file (.npy, in shared memory /dev/shm when available) and only a small handle (file name, shape, dtype)
+# is passed around. Workers attach to it (mosaicCreator, checksumming...) reading the same pages, no copies made
+# Used to hand the volume a NIfTI conversion worker has already loaded over to the snapshot rendering (see parrec2xnat)
+#
+# TO DO:
+# - ...
+
+import os
+import numpy
+import hashlib
+import tempfile
+
+# RAM-backed filesystem if available (Linux), otherwise the default temporary location
+scratchRoot = '/dev/shm' if os.path.isdir('/dev/shm') else None
+# bytes hashed per step when checksumming a volume
+checksumChunk = 16*1024*1024
+# bytes copied per step when publishing a volume (slabs along its last axis)
+publishChunk = 64*1024*1024
+
+class SharedVolume(object):
+    ''' Class for handling a volume published in a memory-mapped scratch file'''
+    ''' Instances are cheap to pickle (file name, shape, dtype and scaling) and behave as a read-only numpy array proxy '''
+    ''' Raw (e.g. PAR/REC stored) values published with a slope/intercept are scaled when the volume is read '''
+
+    def __init__(self, fileName, shape, dtype, slope=None, intercept=None):
+        self.fileName = fileName
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        self.slope = slope
+        self.intercept = intercept
+
+    def __getstate__(self):
+        # never pickle an attached memory map, only the handle
+        return { 'fileName': self.fileName, 'shape': self.shape, 'dtype': self.dtype.str, 'slope': self.slope, 'intercept': self.intercept }
+
+    def __setstate__(self, state):
+        self.__init__(state['fileName'], state['shape'], state['dtype'], state['slope'], state['intercept'])
+
+    def attach(self):
+        '''Map the scratch file into the current process'''
+        '''Returns a read-only numpy memmap'''
+        return numpy.load(self.fileName, mmap_mode='r')
+
+    def __array__(self):
+        data = self.attach()
+        if self.slope is None :
+            return data
+        # same operation (and values) as scaling the data read from the original file
+        return data * self.slope + self.intercept
+
+    def __getitem__(self, slicer):
+        if self.slope is None :
+            return self.attach()[slicer]
+        return numpy.asarray(self)[slicer]
+
+    def checksum(self):
+        '''MD5 digest of the voxel data, hashed straight from the mapped pages'''
+        '''Returns an hexadecimal digest string'''
+
+        data = self.attach().reshape(-1)
+        digest = hashlib.md5()
+        step = max(1, checksumChunk // max(1, data.itemsize))
+        for start in xrange(0, data.size, step) :
+            digest.update(numpy.ascontiguousarray(data[start:start+step]))
+        return digest.hexdigest()
+
+    def release(self):
+        '''Delete the scratch file (attached maps stay valid until closed)'''
+        if os.path.exists(self.fileName) :
+            os.remove(self.fileName)
+
+def publishVolume(imageData, scratchDir=None, slope=None, intercept=None):
+    '''Copy a volume (numpy array or lazy array proxy) once into a new memory-mapped scratch file, slab by slab along its '''
+    '''last axis (a lazy proxy is never loaded whole), optionally with the slope/intercept scaling its raw values'''
+    '''Returns a SharedVolume handle'''
+
+    shape = tuple(imageData.shape)
+    slabSize = int(numpy.prod(shape[:-1]))
+    fd, fileName = tempfile.mkstemp(suffix='.npy', prefix='volume_', dir=scratchDir or scratchRoot)
+    os.close(fd)
+    try:
+        outData = None
+        start, step = 0, 1
+        while start < shape[-1] :
+            slab = numpy.asarray(imageData[..., start:start+step])
+            if outData is None :
+                # data type only known from the first slab read (proxies), the next slabs sized after it
+                outData = numpy.lib.format.open_memmap(fileName, mode='w+', dtype=slab.dtype, shape=shape)
+                step = max(1, publishChunk // max(1, slabSize * slab.dtype.itemsize))
+            outData[..., start:start+slab.shape[-1]] = slab
+            start += slab.shape[-1]
+        outData.flush()
+        dtype = outData.dtype
+        del outData
+    except:
+        os.remove(fileName)
+        raise
+
+    return SharedVolume(fileName, shape, dtype, slope, intercept)
@@ -0,0 +1,389 @@
+#!/usr/bin/python
+
+# Created 2026-10-19, Jordi Huguet, Neuroimaging ICT BBRC Barcelona
+
+####################################
+__author__      = 'Jordi Huguet'  ##
+__dateCreated__ = '20261019'      ##
+__version__     = '0.1.0'         ##
+__versionDate__ = '20261019'      ##
+####################################
+
+# snapshotBackfill.py
+# Create the missing SNAPSHOTS resources (as parrec2xnat does) of scans already archived in an XNAT project
+# Scans are found from a per-session bulk listing of scan resources, and processed in three concurrent stages:
+# download (only the first volume of the NIFTI or PARREC resource data), render (mosaicCreator) and upload
+#
+# TO DO:
+# - ...
+
+import os
+import sys
+import time
+import shutil
+import struct
+import getpass
+import argparse
+import urllib
+import urlparse
+import httplib
+import tempfile
+import threading
+import traceback
+import Queue
+import multiprocessing
+# custom-brewed libraries
+import xnatLibrary
+import mosaicCreator
+
+resourceLabel = 'SNAPSHOTS'
+# source resources, in order of preference
+sourceLabels = ['NIFTI', 'PARREC']
+# streaming chunk size (bytes)
+chunkSize = 1024*1024
+# size of the NIfTI-1 header plus the extension flag bytes
+niftiHeaderSize = 352
+
+def listCandidates(XNAT, experimentID, force=False):
+    '''Find the scans of an MRI session lacking a SNAPSHOTS resource, from a single listing of its scan resources'''
+    '''Returns a list of job dictionaries (experiment, scan ID, scan type, source resource label)'''
+
+    scanResources = {}
+    for record in XNAT.getResources(experimentID).values() :
+        scanResources.setdefault(record['cat_id'], {})[record['label']] = record
+
+    jobs = []
+    for scanID, resources in sorted(scanResources.iteritems()) :
+        if resourceLabel in resources and not force :
+            continue
+        sources = [ label for label in sourceLabels if label in resources ]
+        if not sources :
+            continue
+        jobs.append({ 'experiment': experimentID, 'scan': scanID, 'type': resources[sources[0]]['cat_desc'], 'source': sources[0] })
+
+    return jobs
+
+def fetchFile(XNAT, URL, outFile, length=None):
+    '''Stream an XNAT file down to disk, or only its first length bytes if provided (HTTP Range request)'''
+    '''Returns the number of bytes written'''
+
+    (scheme, netloc, path, params, query, fragment) = urlparse.urlparse(URL)
+
+    headers = {}
+    headers['Accept'] = "*/*"
+    headers['Cookie'] = "JSESSIONID=%s" %XNAT.jsession
+    if length is not None :
+        headers['Range'] = "bytes=0-%d" %(length-1)
+
+    if scheme == 'https' :
+        connection = httplib.HTTPSConnection(netloc, timeout=100, context=XNAT.ssl_context)
+    else :
+        connection = httplib.HTTPConnection(netloc, timeout=100)
+
+    try:
+        connection.request('GET', path, "", headers)
+        response = connection.getresponse()
+        if response.status not in [200, 206] :
+            raise xnatLibrary.XNATException('HTTP response: #%s - %s' % (response.status, response.reason))
+
+        # servers ignoring the Range header (HTTP 200) are just not read further than needed
+        written = 0
+        with open(outFile, 'wb') as fobj :
+            while length is None or written < length :
+                chunk = response.read(chunkSize if length is None else min(chunkSize, length - written))
+                if not chunk :
+                    break
+                fobj.write(chunk)
+                written += len(chunk)
+    finally:
+        connection.close()
+
+    return written
+
+def firstNiftiVolume(XNAT, URL, outFile):
+    '''Download the header and first volume of a NIfTI file, rewritten as a 3D NIfTI file'''
+    '''Returns the number of bytes downloaded'''
+
+    downloaded = fetchFile(XNAT, URL, outFile, niftiHeaderSize)
+    with open(outFile, 'rb') as fobj :
+        header = fobj.read()
+
+    # header endianness from the sizeof_hdr field
+    endian = '<' if struct.unpack('<i', header[0:4])[0] == 348 else '>'
+    if struct.unpack(endian + 'i', header[0:4])[0] != 348 :
+        raise Exception('Not a NIfTI-1 file: %s' %URL)
+    dim = list(struct.unpack(endian + '8h', header[40:56]))
+    bitpix = struct.unpack(endian + 'h', header[72:74])[0]
+    voxOffset = int(struct.unpack(endian + 'f', header[108:112])[0])
+
+    volumeBytes = dim[1] * max(dim[2],1) * max(dim[3],1) * bitpix // 8
+    downloaded += fetchFile(XNAT, URL, outFile, voxOffset + volumeBytes)
+
+    # truncated file declared as a single volume
+    if dim[0] > 3 :
+        dim[0], dim[4] = 3, 1
+        with open(outFile, 'r+b') as fobj :
+            fobj.seek(40)
+            fobj.write(struct.pack(endian + '8h', *dim))
+
+    return downloaded
+
+def firstPARRECVolume(XNAT, parURL, recURL, recSize, parFile, recFile):
+    '''Download a PAR file and the REC data prefix holding its first volume slices'''
+    '''The REC file is extended (sparse, not downloaded) to its full size so it can be loaded as usual'''
+    '''Returns the number of bytes downloaded'''
+
+    import nibabel.parrec
+
+    downloaded = fetchFile(XNAT, parURL, parFile)
+    with open(parFile, 'rb') as fobj :
+        hdr = nibabel.parrec.PARRECHeader.from_fileobj(fobj)
+
+    recShape = hdr.get_rec_shape()
+    if len(hdr.get_data_shape()) == 4 :
+        # same slices mosaicCreator.PARRECVolumeProxy reads for the first volume
+        nSlices = hdr.get_data_shape()[2]
+        lastFrame = max(hdr.get_sorted_slice_indices()[:nSlices])
+        length = (lastFrame + 1) * recSize // recShape[2]
+    else :
+        length = recSize
+    downloaded += fetchFile(XNAT, recURL, recFile, length)
+
+    with open(recFile, 'r+b') as fobj :
+        fobj.truncate(recSize)
+
+    return downloaded
+
+def downloadSource(XNAT, job, workDir):
+    '''Download stage: fetch the first volume of a scan source resource into workDir'''
+    '''Returns the image file to render (NIfTI or PAR file)'''
+
+    URL = XNAT.host + '/data/experiments/%s/scans/%s/resources/%s/files' %(job['experiment'], job['scan'], job['source'])
+    resultSet, response = XNAT.queryURL(URL)
+    files = dict([ (mosaicCreator.fileExtension(record['Name']), record) for record in resultSet ])
+
+    if job['source'] == 'NIFTI' :
+        if 'NII' not in files :
+            raise Exception('No (uncompressed) NIfTI file found in NIFTI resource')
+        imageFile = os.path.join(workDir, files['NII']['Name'])
+        job['bytes'] = firstNiftiVolume(XNAT, XNAT.host + files['NII']['URI'], imageFile)
+    else :
+        if 'PAR' not in files or 'REC' not in files :
+            raise Exception('No PAR/REC file pair found in PARREC resource')
+        imageFile = os.path.join(workDir, files['PAR']['Name'])
+        job['bytes'] = firstPARRECVolume(XNAT, XNAT.host + files['PAR']['URI'], XNAT.host + files['REC']['URI'],
+                                         int(files['REC']['Size']), imageFile, os.path.join(workDir, files['REC']['Name']))
+
+    return imageFile
+
+def renderSnapshot(imageFile, outFile):
+    '''Render stage (worker process): create the snapshot and thumbnail files of an image file'''
+    '''Returns a dictionary with the ORIGINAL and THUMBNAIL files'''
+
+    return mosaicCreator.mosaicCreator(mosaicCreator.imageExtractor(imageFile), outFile, thumb=True)
+
+def uploadSnapshots(XNAT, job, files):
+    '''Upload stage: create the SNAPSHOTS resource of a scan and put the ORIGINAL and THUMBNAIL files'''
+
+    URL = XNAT.host + '/data/experiments/%s/scans/%s/resources/%s' %(job['experiment'], job['scan'], resourceLabel)
+    fileFormat = os.path.splitext(files['ORIGINAL'])[1][1:].upper()
+
+    if XNAT.resourceExist(URL).status == 404 :
+        XNAT.putURL(URL, urllib.urlencode({ 'format': fileFormat, 'content': resourceLabel }))
+
+    for content, suffix in [ ('ORIGINAL', ''), ('THUMBNAIL', '_thumb') ] :
+        fileURL = URL + '/files/' + job['scan'] + suffix + os.path.splitext(files[content])[1]
+        # overwrite only if explicitly asked to (forced backfill of scans already having snapshots)
+        opts_dict = { 'format': fileFormat, 'content': content }
+        if job.get('overwrite') :
+            opts_dict['overwrite'] = 'true'
+        XNAT.putFile(fileURL, files[content], urllib.urlencode(opts_dict))
+
+class SnapshotBackfill(object):
+    ''' Class for running the download, render and upload stages of the snapshot backfill concurrently'''
+    ''' To instantiate properly, provide the XNAT instance, a working directory and the number of workers per stage '''
+
+    def __init__(self, XNAT, workDir, downloaders=4, renderers=None, uploaders=2, verbose=False):
+        self.XNAT = XNAT
+        self.workDir = workDir
+        self.downloaders = downloaders
+        self.renderers = renderers or multiprocessing.cpu_count()
+        self.uploaders = uploaders
+        self.verbose = verbose
+        self.failures = []
+        self.done = []
+        self.lock = threading.Lock()
+
+    def fail(self, job, stage, error):
+        with self.lock :
+            self.failures.append((job, stage, error))
+        print '[Warning] Snapshot %s stage failed for scan %s of %s.\r\n   Reason:: %s' %(stage, job['scan'], job['experiment'], error)
+        if 'dir' in job :
+            shutil.rmtree(job['dir'], ignore_errors=True)
+
+    def download(self, job):
+        start = time.time()
+        job['dir'] = tempfile.mkdtemp(dir=self.workDir, prefix='%s_%s_' %(job['experiment'], job['scan']))
+        job['image'] = downloadSource(self.XNAT, job, job['dir'])
+        job['times'] = { 'download': time.time() - start }
+        return job
+
+    def render(self, job):
+        start = time.time()
+        # bounded by the number of render threads, one job per pool process at a time
+        job['files'] = self.pool.apply(renderSnapshot, (job['image'], os.path.join(job['dir'], job['scan'] + '.png')))
+        job['times']['render'] = time.time() - start
+        return job
+
+    def upload(self, job):
+        start = time.time()
+        uploadSnapshots(self.XNAT, job, job['files'])
+        job['times']['upload'] = time.time() - start
+        shutil.rmtree(job['dir'], ignore_errors=True)
+        with self.lock :
+            self.done.append(job)
+        if self.verbose : print '[Info] Snapshots of scan %s (%s) of %s uploaded (%.1f KB downloaded; download %.2f s, render %.2f s, upload %.2f s)' \
+                                %(job['scan'], job['type'], job['experiment'], job['bytes']/1024., job['times']['download'], job['times']['render'], job['times']['upload'])
+        return job
+
+    def worker(self, stage, function, inQueue, outQueue):
+        '''Stage thread: process jobs from inQueue until a None sentinel arrives, passing them on to outQueue'''
+
+        while True :
+            job = inQueue.get()
+            if job is None :
+                break
+            try:
+                job = function(job)
+            except Exception as e:
+                self.fail(job, stage, e)
+                continue
+            if outQueue is not None :
+                outQueue.put(job)
+
+    def startStage(self, stage, function, nThreads, inQueue, outQueue):
+        threads = [ threading.Thread(target=self.worker, args=(stage, function, inQueue, outQueue)) for n in xrange(nThreads) ]
+        for thread in threads :
+            thread.daemon = True
+            thread.start()
+        return threads
+
+    def stopStage(self, threads, inQueue):
+        '''Let a stage drain its queue and wait for its threads to finish'''
+
+        for thread in threads :
+            inQueue.put(None)
+        for thread in threads :
+            # join with timeout keeps Ctrl-C responsive
+            while thread.is_alive() :
+                thread.join(1)
+
+    def run(self, jobSource):
+        '''Push every job yielded by jobSource through the download, render and upload stages'''
+        '''Returns a tuple (list of completed jobs, list of (job, stage, error) failures)'''
+
+        # bounded queues: downloads do not run (and fill the disk) far ahead of rendering/uploading
+        renderQueue = Queue.Queue(2 * self.renderers)
+        uploadQueue = Queue.Queue(2 * self.uploaders)
+        downloadQueue = Queue.Queue(2 * self.downloaders)
+
+        self.pool = multiprocessing.Pool(processes=self.renderers)
+        try:
+            uploadThreads = self.startStage('upload', self.upload, self.uploaders, uploadQueue, None)
+            renderThreads = self.startStage('render', self.render, self.renderers, renderQueue, uploadQueue)
+            downloadThreads = self.startStage('download', self.download, self.downloaders, downloadQueue, renderQueue)
+
+            # listing overlaps with the stages already running
+            for job in jobSource :
+                downloadQueue.put(job)
+
+            self.stopStage(downloadThreads, downloadQueue)
+            self.stopStage(renderThreads, renderQueue)
+            self.stopStage(uploadThreads, uploadQueue)
+            self.pool.close()
+        except:
+            self.pool.terminate()
+            raise
+        finally:
+            self.pool.join()
+
+        return self.done, self.failures
+
+def listProjectCandidates(XNAT, project, force=False, verbose=False):
+    '''Generator of the backfill jobs of all MRI sessions of a project'''
+
+    experiments = XNAT.getMRSessions(project)
+    if verbose : print '[Info] %d MRI sessions found in project %s' %(len(experiments), project)
+
+    for experimentID in sorted(experiments) :
+        try:
+            jobs = listCandidates(XNAT, experimentID, force)
+        except xnatLibrary.XNATException as xnatErr:
+            print '[Warning] Unable to list scan resources of %s.\r\n   Reason:: %s' %(experiments[experimentID]['label'], xnatErr)
+            continue
+        if verbose and jobs : print '[Info] %d scans of %s lack snapshots' %(len(jobs), experiments[experimentID]['label'])
+        for job in jobs :
+            job['overwrite'] = force
+            yield job
+
+###                                                        ###
+#           top-level script environment                   #
+###                                                        ###
+
+if __name__=="__main__" :
+    print ''
+
+    # argparse trickery
+    parser = argparse.ArgumentParser(description='%s :: Create the missing snapshots of scans archived in XNAT' %os.path.basename(sys.argv[0]))
+    parser.add_argument('-H','--host', dest="hostname", help='XNAT hostname URL (e.g. https://3tmri.nl/xnat)', required=True)
+    parser.add_argument('-p','--proj', dest="project", help='XNAT project ID', required=True)
+    parser.add_argument('-u','--user', dest="username", help='XNAT username (will be prompted for password)', required=True)
+    parser.add_argument('-dw','--download_workers', dest="download_workers", type=int, default=4, help='Number of concurrent downloads (optional, default: 4)', required=False)
+    parser.add_argument('-rw','--render_workers', dest="render_workers", type=int, default=None, help='Number of rendering processes (optional, default: number of CPUs)', required=False)
+    parser.add_argument('-uw','--upload_workers', dest="upload_workers", type=int, default=2, help='Number of concurrent uploads (optional, default: 2)', required=False)
+    parser.add_argument('-n','--dry_run', dest="dry_run", action='store_true', default=False, help='Only list the scans lacking snapshots (optional)', required=False)
+    parser.add_argument('-f','--force', dest="force", action='store_true', default=False, help='Create again the snapshots of all scans, overwriting existing ones (optional)', required=False)
+    parser.add_argument('-v','--verbose', dest="verbose", action='store_true', default=False, help='Display verbosal information (optional)', required=False)
+
+    args = vars(parser.parse_args())
+
+    # compose the HTTP basic authentication credentials string
+    password = getpass.getpass('Password for user %s:' %args['username'])
+    usr_pwd = args['username']+':'+password
+    print ''
+
+    try:
+        # connect to XNAT
+        with xnatLibrary.XNAT(args['hostname'],usr_pwd) as XNAT :
+            if args['verbose'] : print '[Info] session %s opened' %XNAT.jsession
+
+            # check if XNAT project exists
+            if XNAT.resourceExist('%s/data/projects/%s' %(XNAT.host,args['project'])).status != 200 :
+                raise xnatLibrary.XNATException('project ("%s") is unreachable at: %s' % (args['project'], XNAT.host) )
+
+            start = time.time()
+            jobSource = listProjectCandidates(XNAT, args['project'], args['force'], args['verbose'])
+
+            if args['dry_run'] :
+                for job in jobSource :
+                    print '%s\t%s\t%s\t%s' %(job['experiment'], job['scan'], job['type'], job['source'])
+            else :
+                workDir = tempfile.mkdtemp(prefix='snapshotBackfill_')
+                try:
+                    backfill = SnapshotBackfill(XNAT, workDir, args['download_workers'], args['render_workers'], args['upload_workers'], args['verbose'])
+                    done, failures = backfill.run(jobSource)
+                finally:
+                    shutil.rmtree(workDir, ignore_errors=True)
+
+                print '[Info] %d scans backfilled with snapshots (%.1f MB downloaded), %d failed in %.2f s' \
+                      %(len(done), sum([ job['bytes'] for job in done ])/1024.**2, len(failures), time.time() - start)
+
+            # disconnect from XNAT
+            if args['verbose'] : print '[Info] session %s closed' %XNAT.jsession
+
+    except xnatLibrary.XNATException as xnatErr:
+        print '[Error] XNAT-related issue:', xnatErr
+
+    except Exception as e:
+        print '[Error]', e
+        print(traceback.format_exc())
@@ -0,0 +1,188 @@
+#!/usr/bin/python
+
+# Created 2026-10-19, Jordi Huguet, Neuroimaging ICT BBRC Barcelona
+
+####################################
+__author__      = 'Jordi Huguet'  ##
+__dateCreated__ = '20261019'      ##
+__version__     = '0.1.0'         ##
+__versionDate__ = '20261019'      ##
+####################################
+
+# snapshotBatch.py
+# Batch mode of mosaicCreator: render the snapshots (and thumbnails) of a whole directory tree or a manifest
+# of NIfTI/PAR files in a process pool. Outputs mirror the input tree and are skipped when already up to date
+#
+# TO DO:
+# - ...
+
+import os
+import sys
+import time
+import argparse
+import traceback
+import multiprocessing
+# custom-brewed libraries
+import mosaicCreator
+
+# input files rendered (a REC is reached through its PAR)
+batchFormats = ['NII', 'PAR']
+
+def locateImageFiles(inputLocation):
+    '''Walk-through the input location looking for NIfTI/PAR files'''
+    '''Returns a list of file paths'''
+
+    imageFiles = []
+    for root,dirs,files in os.walk(inputLocation):
+        for fileName in sorted(files) :
+            if mosaicCreator.fileExtension(fileName) in batchFormats :
+                imageFiles.append(os.path.join(root,fileName))
+
+    return imageFiles
+
+def readManifest(manifestFile):
+    '''Read a manifest file: one NIfTI/PAR file path per line (relative to the manifest location), # for comments'''
+    '''Returns a list of file paths'''
+
+    baseDir = os.path.dirname(os.path.abspath(manifestFile))
+    imageFiles = []
+    with open(manifestFile, 'r') as fobj :
+        for line in fobj :
+            line = line.strip()
+            if not line or line.startswith('#') :
+                continue
+            imageFiles.append(os.path.join(baseDir, line))
+
+    return imageFiles
+
+def planSnapshots(imageFiles, baseDir, outputDir, thumb=False, force=False):
+    '''Map every input file to its snapshot file (mirroring its path relative to baseDir) and check the outputs'''
+    ''' that are already newer than their inputs'''
+    '''Returns a tuple (list of (input file, snapshot file) jobs to render, list of up-to-date input files)'''
+
+    jobs, upToDate = [], []
+    for imageFile in imageFiles :
+        relPath = os.path.relpath(os.path.abspath(imageFile), baseDir)
+        # input extension kept (e.g. scan.PAR.png), a PAR and a NIfTI of the same scan side by side get their own snapshot
+        outFile = os.path.join(outputDir, relPath + '.png')
+        outFiles = [ outFile ]
+        if thumb :
+            outFiles.append(os.path.splitext(outFile)[0] + '_thumb.png')
+
+        # the snapshot is as old as the oldest of its outputs, and the input as new as the newest of its files
+        inFiles = [ imageFile ]
+        if mosaicCreator.fileExtension(imageFile) == 'PAR' :
+            try:
+                inFiles.append(mosaicCreator.locatePARRECFiles(imageFile)['REC'])
+            except Exception:
+                # missing REC, left to the rendering step to report it
+                pass
+
+        if not force and all([ os.path.isfile(f) for f in outFiles ]) and \
+           min([ os.path.getmtime(f) for f in outFiles ]) >= max([ os.path.getmtime(f) for f in inFiles ]) :
+            upToDate.append(imageFile)
+            continue
+
+        # stale outputs are replaced (mosaicCreator refuses to overwrite)
+        for f in outFiles :
+            if os.path.isfile(f) :
+                os.remove(f)
+        # parent directories created upfront, not raced by the workers
+        if not os.path.isdir(os.path.dirname(outFile)) :
+            os.makedirs(os.path.dirname(outFile))
+        jobs.append((imageFile, outFile))
+
+    return jobs, upToDate
+
+def renderSnapshot(job):
+    '''Worker-side: render the snapshot (and thumbnail) of a single input file'''
+    '''Returns a tuple (input file, output files dictionary or None, elapsed seconds, error message or None)'''
+
+    imageFile, outFile, thumb = job
+    start = time.time()
+    # outputs already there (not created by this job) are never removed on failure
+    outFiles = [ f for f in [ outFile, os.path.splitext(outFile)[0] + '_thumb.png' ] if not os.path.exists(f) ]
+    try:
+        outputFiles = mosaicCreator.mosaicCreator(mosaicCreator.imageExtractor(imageFile), outFile, thumb=thumb)
+        return imageFile, outputFiles, time.time() - start, None
+    except Exception as e:
+        # do not leave half-written outputs around, they would look up to date on the next run
+        for f in outFiles :
+            if os.path.isfile(f) :
+                os.remove(f)
+        return imageFile, None, time.time() - start, str(e)
+
+def renderBatch(jobs, thumb=False, workers=None, verbose=False):
+    '''Render a set of (input file, snapshot file) jobs in a process pool, reporting the per-file timing'''
+    '''Returns a tuple (number of snapshots rendered, list of (input file, error message) failures)'''
+
+    pool = multiprocessing.Pool(processes=workers)
+    nRendered, failures = 0, []
+    try:
+        # one file per task: rendering time per file is large and very uneven (volume sizes)
+        for imageFile, outputFiles, elapsed, error in pool.imap_unordered(renderSnapshot, [ (i, o, thumb) for i, o in jobs ]) :
+            if error is None :
+                nRendered += 1
+                print '[Info] %s rendered in %.2f s' %(imageFile, elapsed)
+                if verbose : print '[Info] Snapshot file created! %s' %outputFiles['ORIGINAL']
+            else :
+                failures.append((imageFile, error))
+                print '[Warning] %s cannot be rendered (%.2f s).\r\n   Reason:: %s' %(imageFile, elapsed, error)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return nRendered, failures
+
+###                                                        ###
+#           top-level script environment                   #
+###                                                        ###
+
+if __name__=="__main__" :
+    print ''
+
+    # argparse trickery
+    parser = argparse.ArgumentParser(description='%s :: Create the mosaic snapshots of a batch of scan datasets (NIfTI/PAR files) as image files' %os.path.basename(sys.argv[0]))
+    inputGroup = parser.add_mutually_exclusive_group(required=True)
+    inputGroup.add_argument('-i','--input', dest="input", help='Input data location (walked recursively)')
+    inputGroup.add_argument('-m','--manifest', dest="manifest", help='Manifest file listing the input files, one per line')
+    parser.add_argument('-o','--output', dest="output", help='Output location (snapshots mirror the input tree)', required=True)
+    parser.add_argument('-t','--thumb', dest="thumbnail", action='store_true', default=False, help='Create thumbnail versions of the mosaics (optional)', required=False)
+    parser.add_argument('-f','--force', dest="force", action='store_true', default=False, help='Render again up-to-date snapshots (optional)', required=False)
+    parser.add_argument('-w','--workers', dest="workers", type=int, default=None, help='Number of rendering processes (optional, default: number of CPUs)', required=False)
+    parser.add_argument('-v','--verbose', dest="verbose", action='store_true', default=False, help='Display verbosal information (optional)', required=False)
+
+    args = vars(parser.parse_args())
+
+    try:
+        start = time.time()
+        if args['input'] :
+            # check validity of input directory provided
+            if not os.path.isdir(args['input']) :
+                raise Exception('Input directory ("%s") not found' %args['input'])
+            imageFiles = locateImageFiles(args['input'])
+            baseDir = os.path.abspath(args['input'])
+        else :
+            if not os.path.isfile(args['manifest']) :
+                raise Exception('Manifest file ("%s") not found' %args['manifest'])
+            imageFiles = readManifest(args['manifest'])
+            # outputs mirror the paths below the deepest directory common to all inputs
+            baseDir = os.path.dirname(os.path.commonprefix([ os.path.abspath(f) for f in imageFiles ]))
+        if args['verbose'] : print '[Info] %d input files found' %len(imageFiles)
+
+        jobs, upToDate = planSnapshots(imageFiles, baseDir, args['output'], args['thumbnail'], args['force'])
+        if args['verbose'] :
+            for imageFile in upToDate :
+                print '[Info] %s snapshot is up to date, skipped' %imageFile
+
+        nRendered, failures = renderBatch(jobs, args['thumbnail'], args['workers'], args['verbose'])
+        elapsed = time.time() - start
+
+        print '[Info] %d snapshots rendered, %d up to date, %d failed in %.2f s' %(nRendered, len(upToDate), len(failures), elapsed)
+
+    except Exception as e:
+        print '[Error]', e
+        print(traceback.format_exc())
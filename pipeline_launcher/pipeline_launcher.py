@@ -22,7 +22,41 @@ import xnatLibrary
 import datetime
 import csv
 import time
+import json
+import socket
+import httplib
+import urlparse
+import collections
 import xml.etree.ElementTree as etree
+from xml.sax.saxutils import escape
+
+# workflow statuses of a finished pipeline job (anything else is still queued/running)
+finished_status = ['Complete', 'Failed', 'Killed']
+# time (seconds) a launched pipeline may take to get its workflow registered before its slot is released anyway
+registration_timeout = 900
+# errors of a single XNAT request (server restarting, network glitch...) not worth aborting a batch run for
+request_errors = (xnatLibrary.XNATException, httplib.HTTPException, socket.error)
+
+# XNAT search of the workflows (wrk:workflowData) of a project pipeline
+workflow_search_xml = '''<?xml version="1.0" encoding="UTF-8"?>
+<xdat:search allow-diff-columns="0" secure="false" brief-description="Workflows" xmlns:xdat="http://nrg.wustl.edu/security" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+    <xdat:root_element_name>wrk:workflowData</xdat:root_element_name>
+    %(fields)s
+    <xdat:search_where method="AND">
+        <xdat:criteria override_value_formatting="0">
+            <xdat:schema_field>wrk:workflowData.ExternalID</xdat:schema_field>
+            <xdat:comparison_type>=</xdat:comparison_type>
+            <xdat:value>%(project)s</xdat:value>
+        </xdat:criteria>
+        <xdat:criteria override_value_formatting="0">
+            <xdat:schema_field>wrk:workflowData.pipeline_name</xdat:schema_field>
+            <xdat:comparison_type>LIKE</xdat:comparison_type>
+            <xdat:value>%%%(pipeline)s%%</xdat:value>
+        </xdat:criteria>
+    </xdat:search_where>
+</xdat:search>'''
+workflow_search_field = '''<xdat:search_field><xdat:element_name>wrk:workflowData</xdat:element_name><xdat:field_ID>%s</xdat:field_ID><xdat:sequence>%d</xdat:sequence><xdat:type>string</xdat:type><xdat:header>%s</xdat:header></xdat:search_field>'''
+workflow_fields = ['ID', 'wrk_workflowData_id', 'pipeline_name', 'status', 'launch_time']
 
 
 def get_project_archive_spec(xnat_connection, project):
@@ -56,6 +90,126 @@ def get_pipeline_alias(xnat_connection,project_name,pipeline_name):
     return pipeline_aliases[pipeline_name]
 
 
+def get_workflows(xnat_connection, project, pipeline_alias):
+    ''' Query all the workflows of a project pipeline at once (XNAT search service) '''
+    '''Returns a dictionary of workflow records (ID, wrk_workflowdata_id, status...) lists per experiment ID '''
+    
+    fields = '\n    '.join([workflow_search_field %(field, n, field) for n, field in enumerate(workflow_fields)])
+    search_xml = workflow_search_xml %{ 'fields': fields, 'project': escape(project), 'pipeline': escape(pipeline_alias) }
+    
+    (scheme, netloc, path, params, query, fragment) = urlparse.urlparse(xnat_connection.host + '/data/search?format=json')
+    
+    headers = {}
+    headers['Content-type'] = "text/xml"
+    headers['Accept'] = "*/*"
+    headers['Cookie'] = "JSESSIONID=%s" %xnat_connection.jsession
+    
+    if scheme == 'https' :
+        connection = httplib.HTTPSConnection(netloc, timeout=100, context=xnat_connection.ssl_context)
+    else :
+        connection = httplib.HTTPConnection(netloc, timeout=100)
+    try:
+        connection.request('POST', path + '?' + query, search_xml, headers)
+        response = connection.getresponse()
+        if response.status != 200 :
+            raise xnatLibrary.XNATException('HTTP response: #%s - %s' % (response.status, response.reason))
+        resultSet = json.loads(response.read())['ResultSet']['Result']
+    finally:
+        connection.close()
+    
+    workflows = {}
+    for record in resultSet :
+        # search results keyed by lowercased field names
+        record = dict([(key.lower(), value) for key, value in record.items()])
+        workflows.setdefault(record['id'], []).append(record)
+    
+    return workflows
+
+
+def workflow_finished(workflow):
+    ''' Check whether a workflow record is in a final state (complete, failed...) '''
+    
+    return any([(workflow.get('status') or '').startswith(status) for status in finished_status])
+
+
+def resolve_sessions(xnat_connection, project, sessionList, verbose=False):
+    ''' Map a list of project experiments, given either by ID or by label, to their experiment IDs '''
+    ''' Unknown experiments and repeated ones are left out (a session is launched once) '''
+    '''Returns the list of experiment IDs, in the given order '''
+    
+    experiments = xnat_connection.getMRSessions(project, { 'format': 'json', 'columns': 'ID,label' })
+    # experiment IDs take precedence over labels (workflows are registered under the experiment ID)
+    lookup = dict([(record['label'], expID) for expID, record in experiments.items()])
+    lookup.update([(expID, expID) for expID in experiments.keys()])
+    
+    resolved = []
+    for session in sessionList :
+        expID = lookup.get(session.strip())
+        if expID is None :
+            print '[Warning] XNAT image session #"%s" not found in project %s, skipped' %(session, project)
+        elif expID in resolved :
+            if verbose : print '[Warning] XNAT image session #"%s" listed more than once, launched once' %session
+        else :
+            resolved.append(expID)
+    
+    return resolved
+
+
+def schedule_pipelines(xnat_connection, project, pipeline_alias, sessionList, max_running, poll_interval, verbose=False):
+    ''' Launch a pipeline over a list of sessions keeping at most max_running of its workflows in flight '''
+    ''' Workflow statuses are polled in bulk and the next session is launched as soon as a slot frees '''
+    ''' Sessions are expected as (unique) experiment IDs, see resolve_sessions() '''
+    '''Returns a dictionary of final workflow status per launched session '''
+    
+    queue = collections.deque(sessionList)
+    # launched sessions with no finished workflow yet: session -> (launch time, workflow IDs known before launching)
+    pending = {}
+    outcome = {}
+    
+    while queue or pending :
+        try:
+            workflows = get_workflows(xnat_connection, project, pipeline_alias)
+        except request_errors as e:
+            # nothing launched nor released until the workflow statuses are known again
+            print '[Warning] Workflow status check failed, retrying in %d s\r\n   Reason:: %s' %(poll_interval, e)
+            time.sleep(poll_interval)
+            continue
+        
+        # workflows of this run: the ones created after launching (not known before)
+        for session in pending.keys() :
+            launch_time, known_ids = pending[session]
+            own = [wf for wf in workflows.get(session, []) if wf.get('wrk_workflowdata_id') not in known_ids]
+            if own and all([workflow_finished(wf) for wf in own]) :
+                outcome[session] = sorted(own, key=lambda wf: wf.get('launch_time'))[-1].get('status')
+                del pending[session]
+                if verbose : print '[Info] Pipeline %s for experiment %s finished: %s' %(pipeline_alias, session, outcome[session])
+            elif not own and time.time() - launch_time > registration_timeout :
+                outcome[session] = 'Unknown'
+                del pending[session]
+                print '[Warning] No workflow registered for experiment %s after %d s, slot released' %(session, registration_timeout)
+        
+        # slots taken by the workflows launched (and not finished) so far; older unfinished workflows (often stale ones) are not counted
+        in_flight = len(pending)
+        
+        while queue and in_flight < max_running :
+            session = queue.popleft()
+            known_ids = set([wf.get('wrk_workflowdata_id') for wf in workflows.get(session, [])])
+            try:
+                xnat_connection.launchPipeline(project, session, pipeline_alias)
+            except request_errors as e:
+                outcome[session] = 'Launch failed'
+                print '[Warning] Pipeline %s could not be launched for experiment %s, skipped\r\n   Reason:: %s' %(pipeline_alias, session, e)
+                continue
+            pending[session] = (time.time(), known_ids)
+            in_flight += 1
+        
+        if verbose : print '[Info] %d workflows in flight, %d sessions queued, %d finished (%s)' %(in_flight, len(queue), len(outcome), datetime.datetime.now())
+        if queue or pending :
+            time.sleep(poll_interval)
+    
+    return outcome
+
+
 def csv_parser(filename, header=None):
     '''Walk-through a CSV file and parse its values, resilient to different delimiters , and ;'''    
     '''By default use 'Session' as header (session unique ID)'''
@@ -94,15 +248,13 @@ if __name__=="__main__" :
     parser.add_argument('-pr','--project', dest="project", help='XNAT project ID', required=True)
     parser.add_argument('-pi','--pipeline', dest="pipeline", help="Pipeline name to be executed", required=True)
     parser.add_argument('-i','--inputCSV', dest="input_csv", help="Expermient list (CSV file)", required=True)
+    parser.add_argument('-n','--max_running', dest="max_running", type=int, default=10, help="Max. number of pipeline workflows in flight (optional, default: 10)", required=False)
+    parser.add_argument('-pt','--poll_interval', dest="poll_interval", type=int, default=60, help="Seconds between workflow status checks (optional, default: 60)", required=False)
     parser.add_argument('-v','--verbose', dest="verbose", action='store_true', default=False, help='Display verbosal information(optional)', required=False)
     parser.add_argument('--version', action='version', version='%(prog)s v{}'.format(__version__))
     
     args = vars(parser.parse_args())
     
-    #Waiting time between each pipeline job is launched not to overstress the system when many jobs are triggered at once
-    #sleep_timespan = 1800 #set to 1/2 hour
-    sleep_timespan = 300 #set to 5 mins.
-    
     # compose the HTTP basic authentication credentials string
     password = getpass.getpass('Password for user %s:' %args['username'])
     usr_pwd = args['username']+':'+password
@@ -131,21 +283,15 @@ if __name__=="__main__" :
             if args['verbose'] and (args['pipeline'] != pipeline_alias) : 
                 print '[Info] Pipeline %s internally renamed as %s (autorun mode enabled), using pipeline alias name (%s) instead' %(args['pipeline'],pipeline_alias,pipeline_alias)
             
-            sessionList = csv_parser(args['input_csv'])
-            i = 0
-            for session in sessionList :
-                i += 1
-                sURL = xnat_connection.host + '/data/archive/experiments/' + session
-                if xnat_connection.resourceExist(sURL).status == 200 :
-                    #response = xnat_connection.launchPipeline(args['project'], session, args['pipeline'])
-                    response = xnat_connection.launchPipeline(args['project'], session, pipeline_alias)
-                    time.sleep(sleep_timespan)
-                    #if i%1 == 0 :
-                    #    time.sleep(sleep_timespan)
-                    
-                else :
-                    if args['verbose'] : print '[Warning] XNAT image session #"%s" not found' %session                                                    
-                        
+            sessionList = resolve_sessions(xnat_connection, args['project'], csv_parser(args['input_csv']), args['verbose'])
+            
+            # rather than sleeping a fixed time after each launch, not to overstress the system when many jobs are triggered
+            # at once, the number of workflows in flight is bounded and the next job launched whenever one finishes
+            outcome = schedule_pipelines(xnat_connection, args['project'], pipeline_alias, sessionList, max(1, args['max_running']), args['poll_interval'], args['verbose'])
+            
+            statuses = collections.Counter(outcome.values())
+            print '[Info] Pipeline %s launched for %d experiments: %s' %(args['pipeline'], len(outcome), ', '.join(['%d %s' %(count, status) for status, count in statuses.most_common()]))
+            
             if args['verbose'] : print '[Info] session closed (%s)' %xnat_connection.host
     
     except xnatLibrary.XNATException as xnatErr:
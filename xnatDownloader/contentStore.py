@@ -0,0 +1,132 @@
+#!/usr/bin/python
+
+# Created 2026-10-19, Jordi Huguet, Neuroimaging ICT BBRC Barcelona
+
+####################################
+__author__      = 'Jordi Huguet'  ##
+__dateCreated__ = '20261019'      ##
+__version__     = '0.1.0'         ##
+__versionDate__ = '20261019'      ##
+####################################
+
+# contentStore.py
+# Local content-addressed store of downloaded files, keyed by their MD5 digest (as reported by XNAT)
+# Every file is stored once (objects/ab/cdef...) and output trees are materialized from the store as hardlinks,
+# reflinks (copy-on-write clones) or plain copies, so repeated exports of the same data need no transfer at all
+#
+# TO DO:
+# - ...
+
+import os
+import stat
+import shutil
+import tempfile
+import subprocess
+
+# ways of materializing a stored file into an output tree (plain copy being the fallback of the others)
+linkModes = ['hardlink', 'reflink', 'copy']
+
+class ContentStore(object):
+    ''' Class with set of functionalities for storing/materializing files in a local content-addressed store'''
+    ''' To instantiate properly, provide the store directory and how files are materialized (see linkModes) '''
+
+    def __init__(self, storeDir, linkMode='hardlink', verbose=False):
+        if linkMode not in linkModes :
+            raise Exception('Wrong or unexpected link mode ("%s")' %linkMode)
+        self.storeDir = storeDir
+        self.linkMode = linkMode
+        self.verbose = verbose
+        if not os.path.exists(os.path.join(self.storeDir, 'objects')) :
+            try:
+                os.makedirs(os.path.join(self.storeDir, 'objects'))
+            except OSError:
+                if not os.path.isdir(os.path.join(self.storeDir, 'objects')):
+                    raise
+
+    def objectPath(self, digest):
+        '''Path of the stored file of a digest (fanned out in folders by its first two characters)'''
+        return os.path.join(self.storeDir, 'objects', digest[:2], digest[2:])
+
+    def has(self, digest, size=None):
+        '''Check whether the file of a digest (and size, if given) is in the store'''
+        objectFile = self.objectPath(digest)
+        return os.path.isfile(objectFile) and (size is None or os.path.getsize(objectFile) == size)
+
+    def copy(self, source, target):
+        '''Copy a file, as a reflink (copy-on-write clone, same data blocks) where the filesystem supports it'''
+        if self.linkMode == 'reflink' :
+            with open(os.devnull, 'w') as devnull :
+                if subprocess.call(['cp', '--reflink=always', source, target], stderr=devnull) == 0 :
+                    return
+        # data only, copies of (read-only) stored files stay writable
+        shutil.copyfile(source, target)
+
+    def materialize(self, digest, target):
+        '''Create (or replace) a file in an output tree from the store'''
+        '''Returns the target path'''
+
+        objectFile = self.objectPath(digest)
+        # created aside and renamed in place, an existing target is replaced atomically
+        tmpName = target + '.link'
+        if os.path.lexists(tmpName) :
+            os.remove(tmpName)
+
+        linked = False
+        if self.linkMode == 'hardlink' :
+            try:
+                os.link(objectFile, tmpName)
+                linked = True
+            except OSError:
+                # hardlinks not supported or store on another filesystem
+                pass
+        if not linked :
+            self.copy(objectFile, tmpName)
+        os.rename(tmpName, target)
+
+        return target
+
+    def put(self, fileName, digest):
+        '''Store a (verified) downloaded file under its digest, the file itself becoming a materialized copy'''
+        '''Returns the path of the stored file'''
+
+        objectFile = self.objectPath(digest)
+        if os.path.isfile(objectFile) :
+            # already stored (e.g. by a concurrent download), the local file is replaced by a link to it
+            self.materialize(digest, fileName)
+            return objectFile
+
+        if not os.path.isdir(os.path.dirname(objectFile)) :
+            try:
+                os.makedirs(os.path.dirname(objectFile))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(objectFile)):
+                    raise
+
+        if self.linkMode == 'hardlink' :
+            try:
+                os.link(fileName, objectFile)
+                self.protect(objectFile)
+                return objectFile
+            except OSError:
+                # stored meanwhile by another process, or hardlinks not possible
+                if os.path.isfile(objectFile) :
+                    self.materialize(digest, fileName)
+                    return objectFile
+
+        # object is staged aside and atomically renamed, so concurrent readers never see a partial file
+        fd, stagingFile = tempfile.mkstemp(dir=os.path.dirname(objectFile), prefix='.staging_')
+        os.close(fd)
+        try:
+            self.copy(fileName, stagingFile)
+            self.protect(stagingFile)
+            os.rename(stagingFile, objectFile)
+        finally:
+            if os.path.exists(stagingFile) :
+                os.remove(stagingFile)
+
+        return objectFile
+
+    def protect(self, objectFile):
+        '''Make a stored file read-only: hardlinked outputs share it, in-place edits would corrupt the store'''
+        mode = os.stat(objectFile).st_mode
+        os.chmod(objectFile, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
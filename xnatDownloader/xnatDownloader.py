@@ -16,16 +16,379 @@ __versionDate__ = '20180321'      ##
 
 import os
 import sys
+import time
 import getpass
 import argparse
 import traceback
 import urllib
+import urlparse
+import httplib
+import socket
 import zipfile
+import zlib
+import tempfile
+import threading
+import multiprocessing.pool
+import Queue
+import json
+import hashlib
+import re
 import xnatLibrary
+import contentStore
 import fnmatch
 
+# streaming chunk size (bytes)
+chunk_size = 1024*1024
+# max. number of concurrent connections per XNAT host (set from the command line)
+max_host_connections = 4
+host_slots = {}
+host_slots_lock = threading.Lock()
+# transfer attempts per file before giving up (interrupted transfers are resumed)
+max_retries = 5
+# files this large (bytes) or larger are fetched as concurrent byte-range segments
+segment_threshold = 64*1024*1024
+# max. number of segments per file (set from the command line, bounded by the per-host connections)
+max_segments = 4
+# seconds between checkpoints of the progress of segmented downloads
+segment_checkpoint = 5
+# local record of the files mirrored (mirror mode), kept at the output directory
+mirror_manifest_name = '.xnat_mirror.json'
+# ZIP members this large (bytes, uncompressed) or larger are extracted concurrently, in a pool of threads
+extract_threshold = 8*1024*1024
+extract_workers = 4
+# local content-addressed store files are materialized from, if any (set from the command line)
+content_store = None
+# report of a shard download, kept next to the shared plan (e.g. plan.shard-2-of-4.json)
+shard_report_format = '%s.shard-%d-of-%d.json'
+
 
 # FUNCTIONS
+class RangeNotSupported(xnatLibrary.XNATException):
+    ''' Byte-range request answered with the whole content '''
+    pass
+
+
+class DownloadStats(object):
+    ''' Thread-safe bookkeeping of the downloaded data: bytes, downloads and failures '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.bytes = 0
+        self.downloads = 0
+        self.skipped = 0
+        self.pruned = 0
+        self.linked = 0
+        self.failures = []
+        self.completed = []
+
+    def add_bytes(self, nbytes):
+        with self.lock :
+            self.bytes += nbytes
+
+    def add_download(self):
+        with self.lock :
+            self.downloads += 1
+
+    def add_skipped(self):
+        with self.lock :
+            self.skipped += 1
+
+    def add_pruned(self):
+        with self.lock :
+            self.pruned += 1
+
+    def add_linked(self):
+        with self.lock :
+            self.linked += 1
+
+    def add_failure(self, label, reason):
+        with self.lock :
+            self.failures.append((label, reason))
+
+    def add_completed(self, experimentID):
+        with self.lock :
+            self.completed.append(experimentID)
+
+    def summary(self):
+        elapsed = time.time() - self.start
+        summary = '%d downloads, %.1f MB in %.1f s (%.2f MB/s), %d failures' %(self.downloads, self.bytes/1024.**2, elapsed, self.bytes/1024.**2/max(elapsed,1e-9), len(self.failures))
+        if self.skipped or self.pruned :
+            summary += ', %d files up to date, %d stale files pruned' %(self.skipped, self.pruned)
+        if self.linked :
+            summary += ', %d files from the local store' %self.linked
+        return summary
+
+
+class MirrorManifest(object):
+    ''' Thread-safe local manifest of mirrored files: path (relative to the output directory) -> size, digest, URI '''
+
+    def __init__(self, outdir):
+        self.lock = threading.Lock()
+        self.fileName = os.path.join(outdir, mirror_manifest_name)
+        self.entries = {}
+        if os.path.isfile(self.fileName) :
+            with open(self.fileName, 'r') as fobj :
+                self.entries = json.load(fobj)
+
+    def get(self, path):
+        with self.lock :
+            return self.entries.get(path)
+
+    def set(self, path, entry):
+        with self.lock :
+            self.entries[path] = entry
+
+    def remove(self, path):
+        with self.lock :
+            self.entries.pop(path, None)
+
+    def paths(self, prefix):
+        with self.lock :
+            return [path for path in self.entries if path.startswith(prefix)]
+
+    def save(self):
+        ''' Write the manifest atomically (temporary file renamed) '''
+        with self.lock :
+            tmpName = self.fileName + '.tmp'
+            with open(tmpName, 'w') as fobj :
+                json.dump(self.entries, fobj, sort_keys=True, indent=0, separators=(',', ': '))
+            os.rename(tmpName, self.fileName)
+
+
+def host_slot(URL):
+    ''' Helper. Get the semaphore bounding the concurrent connections to the host of a URL '''
+
+    netloc = urlparse.urlparse(URL)[1]
+    with host_slots_lock :
+        if netloc not in host_slots :
+            host_slots[netloc] = threading.BoundedSemaphore(max_host_connections)
+        return host_slots[netloc]
+
+
+def stream_resource(URL, options, fobj, stats=None, offset=0, end=None, progress=None):
+    ''' Helper. Stream an XNAT resource down into a file object, within the per-host connection limit '''
+    ''' If offset is given, only the data from that byte on is requested (HTTP Range) and written at that position; '''
+    ''' if end is given too, only the bytes up to it (included) and the server must honour the range. If given, progress '''
+    ''' is called after every chunk written '''
+    
+    (scheme, netloc, path, params, query, fragment) = urlparse.urlparse(URL)
+    if options is not None :
+        path += '?%s' % options
+    
+    headers = {}
+    headers['Accept'] = "*/*"
+    headers['Cookie'] = "JSESSIONID=%s" %amcXNAT.jsession
+    if offset > 0 or end is not None :
+        headers['Range'] = "bytes=%d-%s" %(offset, end if end is not None else '')
+    
+    nbytes = 0
+    with host_slot(URL) :
+        if scheme == 'https' :
+            connection = httplib.HTTPSConnection(netloc, timeout=100, context=amcXNAT.ssl_context)
+        else :
+            connection = httplib.HTTPConnection(netloc, timeout=100)
+        try:
+            connection.request('GET', path, "", headers)
+            response = connection.getresponse()
+            # nothing left beyond offset
+            if offset > 0 and response.status == 416 :
+                return 0
+            if response.status not in [200, 206] :
+                raise xnatLibrary.XNATException('HTTP response: #%s - %s' % (response.status, response.reason))
+            
+            # range not honoured by the server, whole content sent again
+            if end is not None and response.status == 200 :
+                raise RangeNotSupported('Byte ranges not supported for %s' %URL)
+            if offset > 0 and response.status == 200 :
+                offset = 0
+                fobj.truncate(0)
+            fobj.seek(offset)
+            
+            while True :
+                chunk = response.read(chunk_size)
+                if not chunk :
+                    break
+                fobj.write(chunk)
+                nbytes += len(chunk)
+                if stats is not None :
+                    stats.add_bytes(len(chunk))
+                if progress is not None :
+                    progress()
+        finally:
+            connection.close()
+    
+    return nbytes
+
+
+def file_digest(fileName):
+    ''' Helper. MD5 digest of a local file (as reported by XNAT) '''
+    
+    digest = hashlib.md5()
+    with open(fileName, 'rb') as fobj :
+        for chunk in iter(lambda: fobj.read(chunk_size), b'') :
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_segments(segments_file, size, segments):
+    ''' Helper. Record the progress of the segments of a download (sidecar file of the preallocated .part), atomically '''
+    
+    tmpName = segments_file + '.tmp'
+    with open(tmpName, 'w') as fobj :
+        json.dump({ 'size': size, 'segments': segments }, fobj)
+    os.rename(tmpName, segments_file)
+
+
+def fetch_segment(URL, part_file, segment, stats=None, checkpoint=None):
+    ''' Helper. Fetch a [start, end, position] segment of a file (bytes position-end, included) into its place of a '''
+    ''' preallocated .part file. Position only moves past data flushed to the file, and is checkpointed every now and then '''
+    
+    start, end = segment[0], segment[1]
+    with open(part_file, 'r+b') as fobj :
+        last = [time.time()]
+        def progress():
+            if checkpoint is not None and time.time() - last[0] >= segment_checkpoint :
+                fobj.flush()
+                segment[2] = fobj.tell()
+                checkpoint()
+                last[0] = time.time()
+        
+        for attempt in xrange(max_retries) :
+            if segment[2] > end :
+                return
+            fobj.seek(segment[2])
+            try:
+                stream_resource(URL, None, fobj, stats, segment[2], end, progress)
+            except (socket.error, httplib.HTTPException) as e:
+                time.sleep(min(2**attempt, 30))
+            # resume right after the data already written
+            fobj.flush()
+            segment[2] = fobj.tell()
+            if checkpoint is not None :
+                checkpoint()
+        if segment[2] > end :
+            return
+    
+    raise xnatLibrary.XNATException('Transfer of bytes %d-%d of %s failed after %d attempts' %(start, end, URL, max_retries))
+
+
+def download_segments(URL, part_file, size, stats=None):
+    ''' Helper. Download a file as concurrent byte-range segments, each one over its own connection (per-host limit '''
+    ''' applies) and written at its own offset of a preallocated .part file. The progress of every segment is kept in a '''
+    ''' sidecar file (.part.segments), an interrupted download (this or an earlier run) resumes its segments '''
+    
+    segments_file = part_file + '.segments'
+    segments = None
+    if os.path.isfile(segments_file) and os.path.isfile(part_file) and os.path.getsize(part_file) == size :
+        with open(segments_file, 'r') as fobj :
+            state = json.load(fobj)
+        if state.get('size') == size :
+            segments = state['segments']
+    
+    if segments is None :
+        # a single-stream partial transfer (no sidecar) is a genuine prefix of the file, kept
+        prefix = 0
+        if os.path.isfile(part_file) and not os.path.isfile(segments_file) and os.path.getsize(part_file) < size :
+            prefix = os.path.getsize(part_file)
+        nsegments = max(1, min(max_segments, max_host_connections))
+        step = max(1, -(-(size-prefix) // nsegments))
+        segments = [[start, min(start+step, size)-1, start] for start in xrange(prefix, size, step)]
+        
+        # sidecar written before preallocating: a preallocated .part never goes without it
+        save_segments(segments_file, size, segments)
+        with open(part_file, 'r+b' if prefix > 0 else 'wb') as fobj :
+            fobj.truncate(size)
+    
+    lock = threading.Lock()
+    def checkpoint():
+        with lock :
+            save_segments(segments_file, size, segments)
+    
+    errors = []
+    def segment_worker(segment):
+        try:
+            fetch_segment(URL, part_file, segment, stats, checkpoint)
+        except Exception as e:
+            errors.append(e)
+    
+    workers = [threading.Thread(target=segment_worker, args=(segment,)) for segment in segments if segment[2] <= segment[1]]
+    for worker in workers :
+        worker.daemon = True
+        worker.start()
+    for worker in workers :
+        while worker.is_alive() :
+            worker.join(1)
+    
+    if errors :
+        raise errors[0]
+    
+    os.remove(segments_file)
+    
+    return
+
+
+def download_file(URL, local_file, size=None, digest=None, stats=None):
+    ''' Helper. Resumable download of a single file: data goes to a .part file, interrupted transfers are resumed '''
+    ''' (HTTP Range) and the file is renamed in place only once its size and MD5 digest match the server ones '''
+    ''' Large files are fetched as concurrent segments first, a single stream being the fallback '''
+    
+    part_file = local_file + '.part'
+    segments_file = part_file + '.segments'
+    resumed = False
+    # segmented transfers in progress (sidecar file) are resumed as such, whatever the current number of segments
+    if size is not None and (os.path.isfile(segments_file) or (size >= segment_threshold and max_segments > 1)) :
+        try:
+            download_segments(URL, part_file, size, stats)
+            # complete (but unverified) transfer, any mismatch gets retried from scratch below
+            resumed = True
+        except RangeNotSupported as e:
+            print '[Warning] Segmented transfer of %s failed, falling back to a single stream. %s' %(os.path.basename(local_file), e)
+            for fileName in [part_file, segments_file] :
+                if os.path.isfile(fileName) :
+                    os.remove(fileName)
+    # a preallocated .part is not a prefix of the file, never resumed as such
+    elif os.path.isfile(segments_file) :
+        for fileName in [part_file, segments_file] :
+            if os.path.isfile(fileName) :
+                os.remove(fileName)
+    
+    for attempt in xrange(max_retries) :
+        # resume from a previous partial transfer (this or an earlier run), unless it cannot be a prefix of the file
+        offset = os.path.getsize(part_file) if os.path.isfile(part_file) else 0
+        if size is not None and offset > size :
+            offset = 0
+        resumed = resumed or offset > 0
+        
+        # nothing left to transfer if complete already (e.g. segmented download), only verified
+        if size is None or offset < size :
+            try:
+                with open(part_file, 'r+b' if offset > 0 else 'wb') as fobj :
+                    stream_resource(URL, None, fobj, stats, offset)
+            except (socket.error, httplib.HTTPException) as e:
+                print '[Warning] Transfer of %s interrupted (attempt %d/%d), resuming. %s' %(os.path.basename(local_file), attempt+1, max_retries, e)
+                time.sleep(min(2**attempt, 30))
+                continue
+        
+        # short read (connection dropped without error), resume
+        if size is not None and os.path.getsize(part_file) < size :
+            print '[Warning] Transfer of %s incomplete (attempt %d/%d), resuming.' %(os.path.basename(local_file), attempt+1, max_retries)
+            continue
+        
+        if (size is not None and os.path.getsize(part_file) != size) or (digest is not None and file_digest(part_file) != digest) :
+            os.remove(part_file)
+            # resumed data may come from a stale partial file, try once more from scratch before giving up
+            if resumed :
+                resumed = False
+                continue
+            raise xnatLibrary.XNATException('Size or digest mismatch for %s' %URL)
+        
+        os.rename(part_file, local_file)
+        return
+    
+    raise xnatLibrary.XNATException('Transfer of %s failed after %d attempts' %(URL, max_retries))
+
+
 def get_mrsession_list(xnatURL, project):
     ''' Helper. Get list of MRi sessions '''
     
@@ -42,28 +405,161 @@ def get_mrsession_list(xnatURL, project):
     return experiments
     
     
-def get_resource_zip(xnatURL, experimentUID, resource_type, output_location, resource_list):
-    ''' Helper. Download MRi session resources '''
+def get_scan_inventory(xnatURL, project, scan_type=None):
+    ''' Helper. Get every scan of a project (ID, type, session ID, subject label) in a single query, indexed by session '''
+    ''' If a scan type (fnmatch pattern) is given, the server only lists the matching scans, when it supports the pattern '''
     
-    if not resource_type in ['scans', 'resources'] :
+    query_options = {}
+    query_options['xsiType'] = 'xnat:mrSessionData'
+    query_options['format'] = 'json'
+    query_options['columns'] = 'subject_label,label,xnat:mrScanData/ID,xnat:mrScanData/type'
+    # XNAT only understands the '*' wildcard, patterns with '?' or '[...]' are matched by the client alone
+    if scan_type is not None and scan_type != '*' and not any([c in scan_type for c in '?[']) :
+        query_options['xnat:mrScanData/type'] = scan_type
+    query_options = urllib.urlencode(query_options)
+    
+    URL = amcXNAT.normalizeURL(xnatURL) + '/data/projects/%s/experiments' % project
+    
+    # one row per scan (sessions with no scans have no row at all)
+    records,response = amcXNAT.queryURL(URL, query_options)
+    
+    inventory = {}
+    for record in records :
+        scans = inventory.setdefault(record['xnat:mrsessiondata/id'], {})
+        if record.get('xnat:mrscandata/id') :
+            scans[record['xnat:mrscandata/id']] = { 'ID': record['xnat:mrscandata/id'], 'type': record['xnat:mrscandata/type'], 'subject_label': record['subject_label'] }
+    
+    return inventory
+    
+    
+def get_reconstruction_inventory(xnatURL, project):
+    ''' Helper. Get every reconstruction of a project (ID, type) in a single query, indexed by session '''
+    
+    query_options = {}
+    query_options['xsiType'] = 'xnat:mrSessionData'
+    query_options['format'] = 'json'
+    query_options['columns'] = 'subject_label,label,xnat:reconstructedImageData/ID,xnat:reconstructedImageData/type'
+    query_options = urllib.urlencode(query_options)
+    
+    URL = amcXNAT.normalizeURL(xnatURL) + '/data/projects/%s/experiments' % project
+    
+    # one row per reconstruction (sessions with no reconstructions have no row at all)
+    records,response = amcXNAT.queryURL(URL, query_options)
+    
+    inventory = {}
+    for record in records :
+        reconstructions = inventory.setdefault(record['xnat:mrsessiondata/id'], {})
+        if record.get('xnat:reconstructedimagedata/id') :
+            reconstructions[record['xnat:reconstructedimagedata/id']] = { 'ID': record['xnat:reconstructedimagedata/id'], 'type': record.get('xnat:reconstructedimagedata/type') }
+    
+    return inventory
+    
+    
+def resource_files_URL(xnatURL, experimentUID, resource_type, resource_list, resource_labels=None):
+    ''' Helper. URL of the files of a set of MRi session scans (optionally only some of their resources), resources or '''
+    ''' of the output resources of a reconstruction '''
+    
+    if not resource_type in ['scans', 'resources', 'reconstructions'] :
         raise Exception('Wrong or unexpected resource type ("%s")' %resource_type)
     
-    resource_list_str = ','.join(resource_list)
+    URL = amcXNAT.normalizeURL(xnatURL) + '/data/experiments/%s/%s/%s' % (experimentUID,resource_type,','.join(resource_list))
+    # scan resources (e.g. NIFTI, DICOM) selected by label server-side
+    if resource_type == 'scans' and resource_labels :
+        URL += '/resources/%s' % ','.join(resource_labels)
+    # reconstruction output resources, all of them unless selected by label
+    if resource_type == 'reconstructions' :
+        URL += '/out/resources/%s' % (','.join(resource_labels) if resource_labels else 'ALL')
+    
+    return URL + '/files'
+    
+    
+def path_selected(path, includes=None, excludes=None):
+    ''' Helper. Check a file path (as in the ZIP archives, session/scans/...) against include and exclude glob patterns '''
+    
+    if includes and not any([fnmatch.fnmatch(path, pattern) for pattern in includes]) :
+        return False
+    if excludes and any([fnmatch.fnmatch(path, pattern) for pattern in excludes]) :
+        return False
+    return True
+
+
+def file_crc32(fileName):
+    ''' Helper. CRC-32 of a local file (as stored in ZIP archives) '''
+    
+    crc = 0
+    with open(fileName, 'rb') as fobj :
+        for chunk in iter(lambda: fobj.read(chunk_size), b'') :
+            crc = zlib.crc32(chunk, crc)
+    return crc & 0xffffffff
+
+
+def extract_zip(zipName, output_location, includes=None, excludes=None, stats=None):
+    ''' Helper. Extract the members of a ZIP file selected by include/exclude globs, skipping the ones already present '''
+    ''' (same size and CRC). Large members are decompressed concurrently (zlib releases the GIL), small ones in place '''
+    
+    archive = zipfile.ZipFile(zipName, 'r')
+    pool = multiprocessing.pool.ThreadPool(extract_workers)
+    try:
+        pending = []
+        for member in archive.infolist() :
+            if member.filename.endswith('/') or not path_selected(member.filename, includes, excludes) :
+                continue
+            
+            target = os.path.join(output_location, member.filename)
+            if os.path.isfile(target) and os.path.getsize(target) == member.file_size and file_crc32(target) == member.CRC :
+                if stats is not None :
+                    stats.add_skipped()
+                continue
+            # never written in place: the file may be a (read-only) link to a content store object
+            if os.path.isfile(target) :
+                os.remove(target)
+            
+            # folders created upfront, extracting threads would race for them
+            if not os.path.isdir(os.path.dirname(target)) :
+                try:
+                    os.makedirs(os.path.dirname(target))
+                except OSError:
+                    if not os.path.isdir(os.path.dirname(target)):
+                        raise
+            
+            # a ZipFile created from a file name opens the file again for every member read: safe across threads
+            if member.file_size >= extract_threshold :
+                pending.append(pool.apply_async(archive.extract, (member, output_location)))
+            else :
+                archive.extract(member, output_location)
+        
+        for result in pending :
+            result.get()
+    finally:
+        pool.close()
+        pool.join()
+        archive.close()
+    
+    return
+
+
+def get_resource_zip(xnatURL, experimentUID, resource_type, output_location, resource_list, stats=None, resource_labels=None, file_format=None, includes=None, excludes=None):
+    ''' Helper. Download MRi session resources '''
+    ''' Scan (and reconstruction) files can be restricted server-side to some resource labels and/or a file format '''
+    ''' (e.g. NIFTI), and the archive members extracted to the ones selected by include/exclude globs '''
+    
     query_options = {}
     query_options['format'] = 'zip'
-    # uncomment to uniquely download NIFTI formatted scan files
-    #if resource_type == 'scans' :
-    #    query_options['file_format'] = 'NIFTI'
+    if resource_type != 'resources' and file_format is not None :
+        query_options['file_format'] = file_format
     query_options = urllib.urlencode(query_options)
     
-    URL = amcXNAT.normalizeURL(xnatURL) + '/data/experiments/%s/%s/%s/files' % (experimentUID,resource_type,resource_list_str)
-    output, response = amcXNAT.getResource(URL, query_options)
+    URL = resource_files_URL(xnatURL, experimentUID, resource_type, resource_list, resource_labels)
     
     try:
-        tmpFile = os.tmpfile()
+        # ZIP data streamed to disk, never held in memory as a whole (named file, reopened by every extracting thread)
+        tmpFile = tempfile.NamedTemporaryFile(suffix='.zip')
     
-        tmpFile.write(output)
-        zipfile.ZipFile(tmpFile, 'r').extractall(output_location)
+        stream_resource(URL, query_options, tmpFile, stats)
+        tmpFile.flush()
+        extract_zip(tmpFile.name, output_location, includes, excludes, stats)
+        if stats is not None :
+            stats.add_download()
     
     except Exception as e:
        raise e 
@@ -74,6 +570,401 @@ def get_resource_zip(xnatURL, experimentUID, resource_type, output_location, res
     return
    
     
+def list_resource_files(xnatURL, experimentUID, resource_type, resource_list, resource_labels=None, file_format=None):
+    ''' Helper. List the files (name, size, digest, URI...) of a set of MRi session scans, resources or reconstructions '''
+    ''' Scan (and reconstruction) files can be restricted server-side to some resource labels and/or a file format '''
+    
+    query_options = {}
+    query_options['format'] = 'json'
+    if resource_type != 'resources' and file_format is not None :
+        query_options['file_format'] = file_format
+    query_options = urllib.urlencode(query_options)
+    
+    # reconstructions listed one by one
+    if resource_type == 'reconstructions' :
+        files = []
+        for reconstruction in resource_list :
+            URL = resource_files_URL(xnatURL, experimentUID, resource_type, [reconstruction], resource_labels)
+            files += amcXNAT.queryURL(URL, query_options)[0]
+        return files
+    
+    URL = resource_files_URL(xnatURL, experimentUID, resource_type, resource_list, resource_labels)
+    files,response = amcXNAT.queryURL(URL, query_options)
+    
+    return files
+    
+    
+def local_file_path(expt, resource_type, record, scans_data):
+    ''' Helper. Local path of a listed file, laid out as in the ZIP archives (session/scans/ID-type/resources/label/files/...) '''
+    
+    file_path = urllib.unquote(record['URI'].split('/files/', 1)[1])
+    if resource_type == 'scans' :
+        scan_id = record['URI'].split('/scans/', 1)[1].split('/', 1)[0]
+        scan_type = re.sub('[^A-Za-z0-9_.-]', '_', scans_data[scan_id]['type']) if scan_id in scans_data else ''
+        return os.path.join(expt['label'], 'scans', '%s-%s' %(scan_id, scan_type), 'resources', record['collection'], 'files', file_path)
+    if resource_type == 'reconstructions' :
+        reconstruction_id = record['URI'].split('/reconstructions/', 1)[1].split('/', 1)[0]
+        return os.path.join(expt['label'], 'reconstructions', reconstruction_id, 'out', 'resources', record['collection'], 'files', file_path)
+    
+    return os.path.join(expt['label'], 'resources', record['collection'], 'files', file_path)
+    
+    
+def mirror_entry(expt, resource_type, record, resources_data, size, digest):
+    ''' Helper. Manifest entry of a mirrored file: what it is (resource label, scan/reconstruction ID and type, format) '''
+    ''' besides its size and digest, so later runs can tell which of their filters cover it '''
+    
+    entry = { 'size': size, 'digest': digest, 'URI': record['URI'], 'collection': record.get('collection'), 'file_format': record.get('file_format') }
+    if resource_type in ['scans', 'reconstructions'] :
+        resource_id = record['URI'].split('/%s/' %resource_type, 1)[1].split('/', 1)[0]
+        entry['ID'] = resource_id
+        entry['type'] = resources_data[resource_id].get('type') if resource_id in resources_data else None
+    
+    return entry
+    
+    
+def mirror_entry_covered(entry, resource_type, args):
+    ''' Helper. Check whether a mirrored file (manifest entry) is covered by the filters of the run (scan/reconstruction type or '''
+    ''' resource label, resource labels, file format), i.e. whether it missing from the listing means it is gone from XNAT '''
+    ''' Files mirrored before these attributes were recorded are only covered by unfiltered runs '''
+    
+    entry = entry or {}
+    
+    # derived resources: filtered by label
+    if resource_type == 'resources' :
+        return fnmatch.fnmatch(entry.get('collection') or '', args['filter'])
+    
+    # scans and reconstructions: filtered by type, then by resource label and file format
+    if args['filter'] != '*' and (entry.get('type') is None or not fnmatch.fnmatch(entry['type'], args['filter'])) :
+        return False
+    if args['resource_labels'] and entry.get('collection') not in args['resource_labels'] :
+        return False
+    if args['file_format'] and entry.get('file_format') != args['file_format'] :
+        return False
+    return True
+    
+    
+def mirror_resource_files(xnatURL, expt, resource_type, working_dir, resource_list, resources_data, manifest, args, stats):
+    ''' Helper. Fetch (per-file GETs, several files at once) only the new or changed files of a set of MRi session scans, '''
+    ''' resources or reconstructions (scans or reconstructions data, as listed, indexed by ID) and prune the ones gone '''
+    
+    # nothing matching left in the session, its files mirrored before may still have to be pruned
+    files = []
+    if resource_list :
+        files = list_resource_files(xnatURL, expt['xnat:mrsessiondata/id'], resource_type, resource_list, args['resource_labels'], args['file_format'])
+    
+    def mirror_file(record):
+        ''' Returns the (local) path of a listed file and whether it failed, None if not selected '''
+        path = os.path.relpath(os.path.join(working_dir, local_file_path(expt, resource_type, record, resources_data)), args['outdir'])
+        local_file = os.path.join(args['outdir'], path)
+        if not path_selected(local_file_path(expt, resource_type, record, resources_data), args['includes'], args['excludes']) :
+            return None, False
+        
+        size = int(record['Size']) if record.get('Size') else None
+        digest = record.get('digest') or None
+        entry = manifest.get(path)
+        
+        # up to date: unchanged remote file already mirrored, or local file matching it (e.g. from a ZIP download)
+        if os.path.isfile(local_file) and (size is None or os.path.getsize(local_file) == size) :
+            if entry is not None and entry.get('size') == size and entry.get('digest') == digest :
+                stats.add_skipped()
+                return path, False
+            if entry is None and digest is not None and file_digest(local_file) == digest :
+                manifest.set(path, mirror_entry(expt, resource_type, record, resources_data, size, digest))
+                stats.add_skipped()
+                return path, False
+        
+        if not os.path.isdir(os.path.dirname(local_file)) :
+            try:
+                os.makedirs(os.path.dirname(local_file))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(local_file)):
+                    raise
+        
+        # already downloaded to the content store (any output tree or run): linked, no transfer
+        if content_store is not None and digest is not None and content_store.has(digest, size) :
+            content_store.materialize(digest, local_file)
+            manifest.set(path, mirror_entry(expt, resource_type, record, resources_data, size, digest))
+            stats.add_linked()
+            if args['verbose']:
+                print '[Info] %s linked from the local store' %path
+            return path, False
+        
+        # resumable transfer, verified against the server size and digest before being renamed in place
+        try:
+            download_file(amcXNAT.normalizeURL(xnatURL) + record['URI'], local_file, size, digest, stats)
+        except xnatLibrary.XNATException as xnatErr:
+            # a failed file does not stop the rest of the session
+            print '[Warning] XNAT-related issue at retrieving %s. %s' %(path, xnatErr)
+            stats.add_failure(path, xnatErr)
+            return path, True
+        if content_store is not None and digest is not None :
+            content_store.put(local_file, digest)
+        manifest.set(path, mirror_entry(expt, resource_type, record, resources_data, size, digest))
+        stats.add_download()
+        if args['verbose']:
+            print '[Info] %s downloaded' %path
+        return path, False
+    
+    # files of a session fetched concurrently (per-host connection limit applies)
+    if args['file_workers'] > 1 and len(files) > 1 :
+        pool = multiprocessing.pool.ThreadPool(min(args['file_workers'], len(files)))
+        try:
+            results = pool.map(mirror_file, files)
+        finally:
+            pool.close()
+            pool.join()
+    else :
+        results = map(mirror_file, files)
+    
+    failures = len([path for path, failed in results if failed])
+    seen = set([path for path, failed in results if path is not None])
+    
+    # files mirrored before for this session and no longer in the archive (only among the ones the filters of this run cover)
+    if args['prune'] :
+        prefix = os.path.join(os.path.relpath(working_dir, args['outdir']), expt['label'], resource_type, '')
+        for path in manifest.paths(os.path.normpath(prefix) + os.sep) :
+            if path in seen :
+                continue
+            session_path = os.path.relpath(os.path.join(args['outdir'], path), working_dir)
+            if not path_selected(session_path, args['includes'], args['excludes']) or not mirror_entry_covered(manifest.get(path), resource_type, args) :
+                continue
+            if os.path.isfile(os.path.join(args['outdir'], path)) :
+                os.remove(os.path.join(args['outdir'], path))
+            manifest.remove(path)
+            stats.add_pruned()
+            if args['verbose']:
+                print '[Info] %s pruned' %path
+    
+    return failures
+    
+    
+def download_experiment(expt, args, stats, manifest=None):
+    ''' Helper. List, filter and download (or mirror, if a manifest is given) the scans, derived resources and/or reconstructions '''
+    ''' of an MRi session '''
+    ''' Returns the number of failed downloads '''
+    
+    failures = 0
+    working_dir = args['outdir']
+    if args['rich_filepath'] :
+        working_dir = os.path.join(args['outdir'], expt['subject_label'])
+        try:
+            os.makedirs(working_dir)
+        except OSError:
+            # already created (e.g. by a concurrent worker for another session of the subject)
+            if not os.path.isdir(working_dir):
+                raise
+    
+    if args['scans'] :
+        try:
+            # scans from the project inventory, queried per session only if the inventory is not available
+            scans_data = expt.get('scans')
+            if scans_data is None :
+                scans_data = amcXNAT.getScans(expt['xnat:mrsessiondata/id'])
+            resource_list = [scan for scan in scans_data if fnmatch.fnmatch(scans_data[scan]['type'], args['filter'])]
+            
+            # mirrored even with no matching scans left, the files of the deleted ones get pruned
+            if manifest is not None :
+                failures += mirror_resource_files(args['hostname'], expt, 'scans', working_dir, resource_list, scans_data, manifest, args, stats)
+            elif len(resource_list) > 0 :
+                get_resource_zip(args['hostname'], expt['xnat:mrsessiondata/id'], 'scans', working_dir, resource_list, stats, args['resource_labels'], args['file_format'], args['includes'], args['excludes'])
+            # Just do nothing if no matching scans
+            if len(resource_list) == 0 and args['verbose'] :
+                print '[Warning] No scans matching %s for %s' %(args['filter'],expt['label'])
+        except xnatLibrary.XNATException as xnatErr:
+            print '[Warning] XNAT-related issue at retrieving scan resource files for %s. %s' %(expt['label'],xnatErr)
+            stats.add_failure('%s (scans)' %expt['label'], xnatErr)
+            failures += 1
+    
+    if args['resources'] :
+        try:
+            resources_data = amcXNAT.getDerivedResources(expt['xnat:mrsessiondata/id']) or {}
+            resource_list = [resources_data[resID]['label'] for resID in resources_data if fnmatch.fnmatch(resources_data[resID]['label'], args['filter'])]
+            
+            if manifest is not None :
+                failures += mirror_resource_files(args['hostname'], expt, 'resources', working_dir, resource_list, {}, manifest, args, stats)
+            elif len(resource_list) > 0:
+                get_resource_zip(args['hostname'], expt['xnat:mrsessiondata/id'], 'resources', working_dir, resource_list, stats, includes=args['includes'], excludes=args['excludes'])
+            # Just do nothing if no matching resources
+            if len(resource_list) == 0 and args['verbose']:
+                print '[Warning] No resources matching %s for %s' % (args['filter'], expt['label'])
+        except xnatLibrary.XNATException as xnatErr:
+            print '[Warning] XNAT-related issue at retrieving resource files for %s. %s' %(expt['label'],xnatErr)
+            stats.add_failure('%s (resources)' %expt['label'], xnatErr)
+            failures += 1
+    
+    if args['reconstructions'] :
+        try:
+            # reconstructions from the project inventory, queried per session only if the inventory is not available
+            recons_data = expt.get('reconstructions')
+            if recons_data is None :
+                recons_data = amcXNAT.getReconstructions(expt['xnat:mrsessiondata/id']) or {}
+            resource_list = [recon for recon in recons_data if fnmatch.fnmatch(recons_data[recon].get('type') or '', args['filter'])]
+            
+            if manifest is not None :
+                failures += mirror_resource_files(args['hostname'], expt, 'reconstructions', working_dir, resource_list, recons_data, manifest, args, stats)
+            elif len(resource_list) > 0 :
+                # one archive per reconstruction (all its output resources)
+                for recon in resource_list :
+                    get_resource_zip(args['hostname'], expt['xnat:mrsessiondata/id'], 'reconstructions', working_dir, [recon], stats, args['resource_labels'], args['file_format'], args['includes'], args['excludes'])
+            # Just do nothing if no matching reconstructions
+            if len(resource_list) == 0 and args['verbose']:
+                print '[Warning] No reconstructions matching %s for %s' % (args['filter'], expt['label'])
+        except xnatLibrary.XNATException as xnatErr:
+            print '[Warning] XNAT-related issue at retrieving reconstruction files for %s. %s' %(expt['label'],xnatErr)
+            stats.add_failure('%s (reconstructions)' %expt['label'], xnatErr)
+            failures += 1
+    
+    return failures
+
+
+def download_worker(queue, args, stats, manifest=None):
+    ''' Helper. Worker thread: download the experiments taken from a queue until a None sentinel arrives '''
+    
+    while True :
+        expt = queue.get()
+        if expt is None :
+            break
+        try:
+            if download_experiment(expt, args, stats, manifest) == 0 :
+                stats.add_completed(expt['xnat:mrsessiondata/id'])
+            if args['verbose']:
+                print '[Info] %s done' %expt['label']
+        except Exception as e:
+            print '[Warning] Unexpected issue at downloading %s. %s' %(expt['label'], e)
+            stats.add_failure(expt['label'], e)
+
+
+def download_pool(experiments, args, stats, manifest=None):
+    ''' Helper. Download a set of experiments in a pool of worker threads (listing, filtering and downloading overlap) '''
+    
+    queue = Queue.Queue()
+    for expt in experiments :
+        queue.put(expt)
+    
+    workers = [threading.Thread(target=download_worker, args=(queue, args, stats, manifest)) for n in xrange(max(1, args['workers']))]
+    for worker in workers :
+        worker.daemon = True
+        worker.start()
+        queue.put(None)
+    
+    for worker in workers :
+        # join with timeout keeps Ctrl-C responsive
+        while worker.is_alive() :
+            worker.join(1)
+    
+    return
+
+
+def parse_shard(shard):
+    ''' Helper. Parse a shard specification "i/N" (i-th share out of N, 1 <= i <= N) into an (i, N) tuple '''
+    
+    try:
+        index, nshards = [int(value) for value in shard.split('/')]
+    except ValueError:
+        raise Exception('Wrong shard specification ("%s"), expected i/N' %shard)
+    if not 1 <= index <= nshards :
+        raise Exception('Wrong shard specification ("%s"), index out of range' %shard)
+    
+    return index, nshards
+
+
+def shard_of(experimentID, nshards):
+    ''' Helper. Shard (1..N) of an experiment: deterministic hash of its ID, the same on every node and run '''
+    
+    return int(hashlib.md5(experimentID).hexdigest(), 16) % nshards + 1
+
+
+def read_plan(planFile):
+    ''' Helper. Read a shared download plan: project, number of shards and experiments (with their shard) '''
+    
+    with open(planFile, 'r') as fobj :
+        return json.load(fobj)
+
+
+def create_plan(planFile, project, experiments, nshards):
+    ''' Helper. Write the shared download plan of a project unless another node did it first, returns the plan in place '''
+    
+    plan = {}
+    plan['project'] = project
+    plan['shards'] = nshards
+    plan['created'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    plan['experiments'] = []
+    for expt in sorted(experiments, key=lambda expt: expt['xnat:mrsessiondata/id']) :
+        record = dict(expt)
+        record['shard'] = shard_of(expt['xnat:mrsessiondata/id'], nshards)
+        plan['experiments'].append(record)
+    
+    # written aside and hard-linked in place: creation is atomic and the first node wins
+    tmpName = '%s.%s.%d.tmp' %(planFile, socket.gethostname(), os.getpid())
+    with open(tmpName, 'w') as fobj :
+        json.dump(plan, fobj, sort_keys=True, indent=0, separators=(',', ': '))
+    try:
+        os.link(tmpName, planFile)
+    except OSError:
+        if not os.path.isfile(planFile) :
+            raise
+    finally:
+        os.remove(tmpName)
+    
+    return read_plan(planFile)
+
+
+def shard_report_file(planFile, index, nshards):
+    ''' Helper. Name of the report file of a shard, next to the plan '''
+    
+    return shard_report_format %(os.path.splitext(planFile)[0], index, nshards)
+
+
+def write_shard_report(planFile, index, nshards, stats):
+    ''' Helper. Record the experiments completed by a shard; re-runs add up to the previous report of the shard '''
+    
+    reportFile = shard_report_file(planFile, index, nshards)
+    completed = set()
+    if os.path.isfile(reportFile) :
+        completed.update(read_plan(reportFile)['completed'])
+    failed = set([label for label, reason in stats.failures])
+    
+    report = {}
+    report['shard'] = index
+    report['shards'] = nshards
+    report['host'] = socket.gethostname()
+    report['finished'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    report['completed'] = sorted(completed.union(stats.completed))
+    report['failed'] = sorted(failed)
+    
+    tmpName = reportFile + '.tmp'
+    with open(tmpName, 'w') as fobj :
+        json.dump(report, fobj, sort_keys=True, indent=0, separators=(',', ': '))
+    os.rename(tmpName, reportFile)
+    
+    return reportFile
+
+
+def check_plan(planFile, verbose=False):
+    ''' Helper. Merge the shard reports of a plan and check every experiment has been downloaded '''
+    ''' Returns True if the plan is complete '''
+    
+    plan = read_plan(planFile)
+    nshards = plan['shards']
+    completed = set()
+    for index in xrange(1, nshards+1) :
+        reportFile = shard_report_file(planFile, index, nshards)
+        if not os.path.isfile(reportFile) :
+            print '[Warning] No report for shard %d/%d' %(index, nshards)
+            continue
+        report = read_plan(reportFile)
+        completed.update(report['completed'])
+        if verbose:
+            print '[Info] Shard %d/%d (%s, %s): %d experiments completed, %d failures' %(index, nshards, report['host'], report['finished'], len(report['completed']), len(report['failed']))
+    
+    missing = [expt for expt in plan['experiments'] if expt['xnat:mrsessiondata/id'] not in completed]
+    for expt in missing :
+        print '[Warning] Experiment %s (shard %d/%d) not downloaded' %(expt['label'], expt['shard'], nshards)
+    print '[Info] Project %s: %d/%d experiments downloaded in %d shards' %(plan['project'], len(plan['experiments'])-len(missing), len(plan['experiments']), nshards)
+    
+    return len(missing) == 0
+
+
 ###                                                    ###
 #       top-level script environment                   #
 ###                                                    ###
@@ -87,12 +978,47 @@ if __name__ == "__main__":
     parser.add_argument('-o','--outdir', dest="outdir", help='Output directory where to store downloaded data', required=True)    
     parser.add_argument('-r','--resources', dest="resources", action='store_true', default=False, help='Download resources/derived data (optional)', required=False)
     parser.add_argument('-s','--scans', dest="scans", action='store_true', default=False, help='Download scanned/raw data (optional)', required=False)
-    parser.add_argument('-f','--filter', dest="filter", default='*', help='Filter out scans/resources by type', required=False)
+    parser.add_argument('-rc','--reconstructions', dest="reconstructions", action='store_true', default=False, help='Download reconstructions output resources (optional)', required=False)
+    parser.add_argument('-f','--filter', dest="filter", default='*', help='Filter out scans/resources/reconstructions by type', required=False)
+    parser.add_argument('-rl','--resource_label', dest="resource_label", default=None, help='Download only these scan/reconstruction resources, comma-separated labels e.g. NIFTI,SNAPSHOTS (optional)', required=False)
+    parser.add_argument('-ff','--file_format', dest="file_format", default=None, help='Download only scan/reconstruction files of this format e.g. NIFTI (optional)', required=False)
+    parser.add_argument('-in','--include', dest="include", default=None, help='Keep only the files matching these comma-separated globs, on paths as session/scans/ID-type/resources/label/files/name e.g. *.nii (optional)', required=False)
+    parser.add_argument('-ex','--exclude', dest="exclude", default=None, help='Skip the files matching these comma-separated globs e.g. */SNAPSHOTS/* (optional)', required=False)
     parser.add_argument('-fp','--rich_filepath', dest="rich_filepath", action='store_true', default=False, help='Include subject in file paths', required=False)
+    parser.add_argument('-m','--mirror', dest="mirror", action='store_true', default=False, help='Mirror mode: fetch file by file (resumable, verified transfers) only new or changed files (optional)', required=False)
+    parser.add_argument('-pr','--prune', dest="prune", action='store_true', default=False, help='Mirror mode: delete local files no longer in XNAT (optional)', required=False)
+    parser.add_argument('-cs','--store', dest="store", default=None, help='Local content-addressed store directory: files are downloaded once and linked into the output directory, implies mirror mode (optional)', required=False)
+    parser.add_argument('-lm','--link_mode', dest="link_mode", default='hardlink', choices=contentStore.linkModes, help='How files are materialized from the store (optional, default: hardlink)', required=False)
+    parser.add_argument('-w','--workers', dest="workers", type=int, default=4, help='Number of experiments downloaded concurrently (optional, default: 4)', required=False)
+    parser.add_argument('-fw','--file_workers', dest="file_workers", type=int, default=4, help='Number of files of a session downloaded concurrently, mirror mode (optional, default: 4)', required=False)
+    parser.add_argument('-sg','--segments', dest="segments", type=int, default=4, help='Max. number of concurrent byte-range segments per large file, mirror mode (optional, default: 4)', required=False)
+    parser.add_argument('-hc','--host_connections', dest="host_connections", type=int, default=4, help='Max. number of concurrent download connections per XNAT host (optional, default: 4)', required=False)
+    parser.add_argument('-sh','--shard', dest="shard", default=None, help='Download only the i-th share of the experiments out of N, e.g. 2/4 (optional)', required=False)
+    parser.add_argument('-pl','--plan', dest="plan", default=None, help='Shared plan file (e.g. on a shared filesystem): experiments and shards, created by the first node if not found, and shard reports next to it (optional)', required=False)
+    parser.add_argument('-c','--check', dest="check", action='store_true', default=False, help='Check the shard reports of a plan are complete, no download (optional)', required=False)
     parser.add_argument('-v','--verbose', dest="verbose", action='store_true', default=False, help='Display verbosal information (optional)', required=False)
     
     args = vars(parser.parse_args())
     
+    # merge step of a sharded download, no XNAT connection needed
+    if args['check'] :
+        if not args['plan'] or not os.path.isfile(args['plan']) :
+            parser.error('a plan file is required for checking (-pl)')
+        sys.exit(0 if check_plan(args['plan'], args['verbose']) else 1)
+    
+    # scan resource labels and file format are passed on to XNAT, only the matching files are sent
+    args['resource_labels'] = args['resource_label'].split(',') if args['resource_label'] else None
+    # include/exclude globs applied to every downloaded file (ZIP members or mirrored files)
+    args['includes'] = args['include'].split(',') if args['include'] else None
+    args['excludes'] = args['exclude'].split(',') if args['exclude'] else None
+    
+    shard = None
+    if args['shard'] :
+        try:
+            shard = parse_shard(args['shard'])
+        except Exception as e:
+            parser.error(str(e))
+    
     # compose the HTTP basic authentication credentials string
     password = getpass.getpass('Password for user %s:' %args['username'])
     usr_pwd = args['username']+':'+password
@@ -100,9 +1026,17 @@ if __name__ == "__main__":
     
     try:         
         
-        if not args['resources'] and not args['scans']:
+        if not args['resources'] and not args['scans'] and not args['reconstructions']:
             sys.exit(0)
         
+        max_host_connections = max(1, args['host_connections'])
+        max_segments = max(1, args['segments'])
+        
+        # per-file transfers needed to know the digests (listing) before downloading anything
+        if args['store'] :
+            content_store = contentStore.ContentStore(args['store'], args['link_mode'], args['verbose'])
+            args['mirror'] = True
+        
         # check validity of output directory provided
         if not os.path.exists(args['outdir']) :
             os.mkdir(args['outdir'])
@@ -112,46 +1046,71 @@ if __name__ == "__main__":
             if args['verbose']:
                 print '[Info] XNAT session %s opened' %amcXNAT.jsession
             
-            # get list of experiments
-            experiments = get_mrsession_list(args['hostname'], args['project'])
-            
-            for expt in experiments:
-                
-                working_dir = args['outdir']
-                if args['rich_filepath'] :               
-                    working_dir = os.path.join(args['outdir'], expt['subject_label'])
-                    if not os.path.exists(working_dir):
-                        os.makedirs(working_dir)
-                
-                if args['scans'] :
-                    try:
-                        scans_data = amcXNAT.getScans(expt['xnat:mrsessiondata/id'])
-                        if scans_data is None :
-                            continue
-                        resource_list = [scan for scan in scans_data if fnmatch.fnmatch(scans_data[scan]['type'], args['filter'])]
-
-                        if len(resource_list) > 0 :
-                            get_resource_zip(args['hostname'], expt['xnat:mrsessiondata/id'], 'scans', working_dir, resource_list)
-                        # Just do nothing if no matching scans
-                        elif args['verbose'] :
-                            print '[Warning] No scans matching %s for %s' %(args['filter'],expt['label'])
-                    except xnatLibrary.XNATException as xnatErr:
-                        print '[Warning] XNAT-related issue at retrieving scan resource files for %s. %s' %(expt['label'],xnatErr)  
-                if args['resources'] :
-                    try:
-                        resources_data = amcXNAT.getDerivedResources(expt['xnat:mrsessiondata/id'])
-                        if resources_data is None :
-                            continue
-                        resource_list = [resources_data[resID]['label'] for resID in resources_data if fnmatch.fnmatch(resources_data[resID]['label'], args['filter'])]
-
-                        if len(resource_list) > 0:
-                            get_resource_zip(args['hostname'], expt['xnat:mrsessiondata/id'], 'resources', working_dir, resource_list)
-                        # Just do nothing if no matching resources
-                        elif args['verbose']:
-                            print '[Warning] No resources matching %s for %s' % (args['filter'], expt['label'])
-                    except xnatLibrary.XNATException as xnatErr:
-                        print '[Warning] XNAT-related issue at retrieving resource files for %s. %s' %(expt['label'],xnatErr)
-                
+            # get list of experiments, from the shared plan if any so that every node splits the same list
+            if args['plan'] and os.path.isfile(args['plan']) :
+                plan = read_plan(args['plan'])
+                if plan['project'] != args['project'] :
+                    raise Exception('Plan %s is for project %s' %(args['plan'], plan['project']))
+            elif args['plan'] :
+                plan = create_plan(args['plan'], args['project'], get_mrsession_list(args['hostname'], args['project']), shard[1] if shard else 1)
+            else :
+                plan = None
+            
+            if plan is not None :
+                if shard is not None and shard[1] != plan['shards'] :
+                    raise Exception('Plan %s is split in %d shards, not %d' %(args['plan'], plan['shards'], shard[1]))
+                experiments = [expt for expt in plan['experiments'] if shard is None or expt['shard'] == shard[0]]
+            else :
+                experiments = get_mrsession_list(args['hostname'], args['project'])
+                if shard is not None :
+                    experiments = [expt for expt in experiments if shard_of(expt['xnat:mrsessiondata/id'], shard[1]) == shard[0]]
+            if shard is not None and args['verbose'] :
+                print '[Info] Shard %d/%d: %d experiments' %(shard[0], shard[1], len(experiments))
+            
+            # scans of all sessions at once, instead of one listing per session
+            if args['scans'] :
+                try:
+                    inventory = get_scan_inventory(args['hostname'], args['project'], args['filter'])
+                    for expt in experiments :
+                        expt['scans'] = inventory.get(expt['xnat:mrsessiondata/id'], {})
+                    if args['verbose']:
+                        print '[Info] Scan inventory: %d scans in %d sessions' %(sum([len(scans) for scans in inventory.values()]), len(inventory))
+                except xnatLibrary.XNATException as xnatErr:
+                    print '[Warning] Project scan inventory not available, scans will be listed per session. %s' %xnatErr
+            # same for reconstructions
+            if args['reconstructions'] :
+                try:
+                    inventory = get_reconstruction_inventory(args['hostname'], args['project'])
+                    for expt in experiments :
+                        expt['reconstructions'] = inventory.get(expt['xnat:mrsessiondata/id'], {})
+                    if args['verbose']:
+                        print '[Info] Reconstruction inventory: %d reconstructions in %d sessions' %(sum([len(recons) for recons in inventory.values()]), len(inventory))
+                except xnatLibrary.XNATException as xnatErr:
+                    print '[Warning] Project reconstruction inventory not available, reconstructions will be listed per session. %s' %xnatErr
+            if args['verbose']:
+                print '[Info] %d experiments found, downloading with %d workers' %(len(experiments), args['workers'])
+            
+            stats = DownloadStats()
+            manifest = None
+            if args['mirror'] :
+                manifest = MirrorManifest(args['outdir'])
+            try:
+                download_pool(experiments, args, stats, manifest)
+            finally:
+                # files mirrored so far are recorded even if the run is interrupted
+                if manifest is not None :
+                    manifest.save()
+            
+            print '[Info] %s' %stats.summary()
+            for label, reason in stats.failures :
+                print '[Warning] Failed download for %s. %s' %(label, reason)
+            
+            # completed experiments reported for the merge step (--check)
+            if plan is not None and (shard is not None or plan['shards'] == 1) :
+                reportFile = write_shard_report(args['plan'], shard[0] if shard else 1, plan['shards'], stats)
+                if args['verbose']:
+                    print '[Info] Shard report written to %s' %reportFile
+            
             if args['verbose']:
                 print '[Info] XNAT session %s closed' %amcXNAT.jsession
     